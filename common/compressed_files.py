@@ -0,0 +1,179 @@
+import bz2
+import io
+import json
+import mmap
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+class ParallelBz2Writer(io.BufferedIOBase):
+    """
+    Binary file that compresses what is written into it as it arrives, without keeping the whole content in memory.
+
+    The content is cut in blocks that are compressed as independent bz2 streams by a pool of threads (bz2 releases
+    the GIL while compressing), so compression runs in parallel with the code producing the content. A file with
+    concatenated bz2 streams is read back transparently by bz2.open, bz2.decompress, pandas and bzip2.
+    """
+    BLOCK_SIZE = 4 * 1024 * 1024
+    COMPRESS_LEVEL = 9
+
+    def __init__(self, file_path, threads=None):
+        super().__init__()
+        self.file_path = file_path
+        self.threads = threads or os.cpu_count() or 1
+        self.file = open(file_path, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending_blocks = deque()
+        self.pending_data = bytearray()
+        self.blocks_written = 0
+        self.uncompressed_size = 0
+        self.compressed_size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        self.pending_data.extend(data)
+        self.uncompressed_size += len(data)
+        while len(self.pending_data) >= self.BLOCK_SIZE:
+            self._submit_block(bytes(self.pending_data[:self.BLOCK_SIZE]))
+            del self.pending_data[:self.BLOCK_SIZE]
+        return len(data)
+
+    def _submit_block(self, block):
+        self.pending_blocks.append(self.executor.submit(bz2.compress, block, self.COMPRESS_LEVEL))
+        while len(self.pending_blocks) > 2 * self.threads:
+            self._write_oldest_block()
+
+    def _write_oldest_block(self):
+        compressed_block = self.pending_blocks.popleft().result()
+        self.file.write(compressed_block)
+        self.compressed_size += len(compressed_block)
+        self.blocks_written += 1
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self.pending_data or self.blocks_written + len(self.pending_blocks) == 0:
+                self._submit_block(bytes(self.pending_data))
+                self.pending_data = bytearray()
+            while self.pending_blocks:
+                self._write_oldest_block()
+        finally:
+            self.executor.shutdown()
+            self.file.close()
+            super().close()
+
+
+def open_bz2_writer(file_path, encoding='utf-8', threads=None):
+    """
+    Text file compressed with bz2 while it is written (see ParallelBz2Writer). Its `buffer` attribute keeps the
+    uncompressed and compressed sizes once it is closed.
+    """
+    return io.TextIOWrapper(ParallelBz2Writer(file_path, threads), encoding=encoding, newline='')
+
+
+class ParallelBz2Reader(io.RawIOBase):
+    """
+    Binary file with the decompressed content of a bz2 file, to be parsed while it is decompressed.
+
+    The bz2 streams of files written by ParallelBz2Writer are decompressed by a pool of threads a few streams ahead of
+    the reader. Files with a single stream (e.g. written by bzip2) are decompressed sequentially.
+    """
+    STREAM_HEADER = re.compile(rb'BZh[1-9]1AY&SY')
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, file_path, threads=None):
+        super().__init__()
+        self.file_path = file_path
+        self.threads = threads or os.cpu_count() or 1
+        self.file = open(file_path, 'rb')
+        self.blocks = self._decompress_blocks()
+        self.current_block = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.current_block:
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.current_block = memoryview(block)
+
+        size = min(len(buffer), len(self.current_block))
+        buffer[:size] = self.current_block[:size]
+        self.current_block = self.current_block[size:]
+        return size
+
+    def readall(self):
+        content = b''.join([bytes(self.current_block)] + list(self.blocks))
+        self.current_block = memoryview(b'')
+        return content
+
+    def _decompress_blocks(self):
+        if os.fstat(self.file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            offsets = [match.start() for match in self.STREAM_HEADER.finditer(content)] + [len(content)]
+            if len(offsets) <= 2 or offsets[0] != 0:
+                yield from self._decompress_sequentially(0)
+                return
+
+            streams = zip(offsets[:-1], offsets[1:])
+            pending_blocks = deque()
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                while True:
+                    for start, end in islice(streams, 2 * self.threads - len(pending_blocks)):
+                        pending_blocks.append((start, executor.submit(bz2.decompress, content[start:end])))
+                    if not pending_blocks:
+                        return
+
+                    start, future = pending_blocks.popleft()
+                    try:
+                        block = future.result()
+                    except (OSError, EOFError, ValueError):
+                        # A header found inside compressed data splits a stream in two invalid blocks. The previous
+                        # blocks ended exactly at this offset, so the rest of the file is decompressed sequentially.
+                        yield from self._decompress_sequentially(start)
+                        return
+                    yield block
+
+    def _decompress_sequentially(self, start):
+        self.file.seek(start)
+        with bz2.BZ2File(self.file) as decompressed_file:
+            for block in iter(lambda: decompressed_file.read(self.READ_SIZE), b''):
+                yield block
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.blocks.close()
+        self.file.close()
+        super().close()
+
+
+def open_compressed_file(file_path, mode='rt', encoding='utf-8', newline=None, threads=None):
+    """
+    Opens a file for reading, decompressing it with ParallelBz2Reader when its extension is .bz2
+    """
+    if not file_path.endswith('.bz2'):
+        return open(file_path, 'rb') if 'b' in mode else open(file_path, 'r', encoding=encoding, newline=newline)
+
+    reader = io.BufferedReader(ParallelBz2Reader(file_path, threads), ParallelBz2Reader.READ_SIZE)
+    return reader if 'b' in mode else io.TextIOWrapper(reader, encoding=encoding, newline=newline)
+
+
+def load_compressed_json(file_path, threads=None):
+    with open_compressed_file(file_path, threads=threads) as file:
+        return json.load(file)
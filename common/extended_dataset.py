@@ -0,0 +1,258 @@
+import csv
+import json
+import os
+from array import array
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from common.compressed_files import open_compressed_file
+from common.file_utils import get_checksum
+
+
+class ExtendedDataset(object):
+    """
+    Films of the extended dataset with their tropes stored as a sparse film x trope matrix.
+
+    The CSV file is decompressed and parsed row by row, so the memory needed scales with the number of
+    (film, trope) pairs instead of films x vocabulary. The parsed arrays are cached next to the source file as
+    numpy files that are memory-mapped on the next load, and the cache is rebuilt when the source checksum changes.
+    The same directory layout is written by the film mapper (see ExtendedDatasetWriter) and can be loaded directly.
+    """
+    META_COLUMNS = ['Id', 'NameTvTropes', 'NameIMDB', 'Rating', 'Votes', 'Year']
+    INDEX_FIRST_TROPE = len(META_COLUMNS)
+    ENCODING = 'utf-8'
+
+    CACHE_EXTENSION = '.cache'
+    MANIFEST = 'manifest.json'
+    FORMAT_VERSION = 1
+    METADATA_ARRAYS = ['ids', 'names_tvtropes', 'names_imdb', 'ratings', 'votes', 'years']
+    ROW_ARRAYS = METADATA_ARRAYS + ['trope_names', 'indices', 'indptr']
+    COLUMN_ARRAYS = ['column_indices', 'column_indptr']
+
+    def __init__(self, ids, names_tvtropes, names_imdb, ratings, votes, years, trope_names, tropes,
+                 tropes_by_column=None):
+        self.ids = ids
+        self.names_tvtropes = names_tvtropes
+        self.names_imdb = names_imdb
+        self.ratings = ratings
+        self.votes = votes
+        self.years = years
+        self.trope_names = trope_names
+        self.tropes = tropes
+        self._tropes_by_column = tropes_by_column
+
+    @classmethod
+    def load(cls, file_path, use_cache=True):
+        if not use_cache and not os.path.isdir(file_path):
+            return cls.from_csv(file_path)
+
+        if os.path.isdir(file_path):
+            return cls.from_directory(file_path)
+
+        cache_directory = cls.get_cache_directory(file_path)
+        checksum = get_checksum(file_path)
+        if cls._is_cache_valid(cache_directory, checksum):
+            return cls.from_directory(cache_directory)
+
+        cls.from_csv(file_path).write_cache(cache_directory, checksum)
+        return cls.from_directory(cache_directory)
+
+    @classmethod
+    def from_csv(cls, file_path):
+        with open_compressed_file(file_path, encoding=cls.ENCODING, newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            trope_names = header[cls.INDEX_FIRST_TROPE:]
+
+            metadata = [[] for _ in cls.META_COLUMNS]
+            indices = array('i')
+            indptr = array('q', [0])
+            for row in reader:
+                for column, value in zip(metadata, row):
+                    column.append(value)
+                indices.extend(cls._get_trope_indexes(row[cls.INDEX_FIRST_TROPE:]))
+                indptr.append(len(indices))
+
+        tropes = cls._build_matrix(np.frombuffer(indices, dtype=np.int32), np.frombuffer(indptr, dtype=np.int64),
+                                   len(trope_names))
+        return cls(*cls._to_metadata_arrays(metadata), np.array(trope_names), tropes)
+
+    @classmethod
+    def from_directory(cls, directory):
+        arrays = {name: cls._load_array(directory, name) for name in cls.ROW_ARRAYS + cls.COLUMN_ARRAYS}
+        number_of_films = len(arrays['ids'])
+        number_of_tropes = len(arrays['trope_names'])
+
+        tropes = cls._build_matrix(arrays['indices'], arrays['indptr'], number_of_tropes)
+        tropes_by_column = None
+        if arrays['column_indices'] is not None and arrays['column_indptr'] is not None:
+            tropes_by_column = sparse.csc_matrix(
+                (np.ones(len(arrays['column_indices'])), arrays['column_indices'], arrays['column_indptr']),
+                shape=(number_of_films, number_of_tropes))
+        return cls(arrays['ids'], arrays['names_tvtropes'], arrays['names_imdb'], arrays['ratings'],
+                   arrays['votes'], arrays['years'], arrays['trope_names'], tropes, tropes_by_column)
+
+    @staticmethod
+    def _load_array(directory, name):
+        file_path = os.path.join(directory, f'{name}.npy')
+        if not os.path.isfile(file_path):
+            return None
+        return np.load(file_path, mmap_mode='r')
+
+    def write_cache(self, cache_directory, checksum):
+        self._prepare_directory(cache_directory)
+
+        tropes_by_column = self.tropes_by_column
+        arrays = dict(ids=self.ids, names_tvtropes=self.names_tvtropes, names_imdb=self.names_imdb,
+                      ratings=self.ratings, votes=self.votes, years=self.years, trope_names=self.trope_names,
+                      indices=self.tropes.indices, indptr=self.tropes.indptr,
+                      column_indices=tropes_by_column.indices, column_indptr=tropes_by_column.indptr)
+        for name, values in arrays.items():
+            self._save_array(cache_directory, name, values)
+
+        self._write_manifest(cache_directory, self.tropes.shape, self.tropes.nnz, checksum)
+
+    @classmethod
+    def _prepare_directory(cls, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        for file_name in [cls.MANIFEST] + [f'{name}.npy' for name in cls.COLUMN_ARRAYS]:
+            file_path = os.path.join(directory, file_name)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
+    @staticmethod
+    def _save_array(directory, name, values):
+        np.save(os.path.join(directory, f'{name}.npy'), np.asarray(values))
+
+    @classmethod
+    def _write_manifest(cls, directory, shape, number_of_values, checksum=None):
+        manifest = dict(format_version=cls.FORMAT_VERSION, source_checksum=checksum, shape=list(shape),
+                        non_zero_values=int(number_of_values))
+        with open(os.path.join(directory, cls.MANIFEST), 'w') as file:
+            json.dump(manifest, file, sort_keys=True)
+
+    @classmethod
+    def get_cache_directory(cls, file_path):
+        base_path = file_path
+        for extension in ['.bz2', '.csv']:
+            if base_path.endswith(extension):
+                base_path = base_path[:-len(extension)]
+        return f'{base_path}{cls.CACHE_EXTENSION}'
+
+    @classmethod
+    def _is_cache_valid(cls, cache_directory, checksum):
+        manifest_path = os.path.join(cache_directory, cls.MANIFEST)
+        if not os.path.isfile(manifest_path):
+            return False
+
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+        return manifest.get('format_version') == cls.FORMAT_VERSION and \
+            manifest.get('source_checksum') == checksum
+
+    @property
+    def tropes_by_column(self):
+        if self._tropes_by_column is None:
+            self._tropes_by_column = self.tropes.tocsc()
+        return self._tropes_by_column
+
+    def to_dataframe(self, columns=None):
+        if columns is None:
+            columns = self.META_COLUMNS + list(self.trope_names)
+
+        metadata = dict(zip(self.META_COLUMNS, [self.ids, self.names_tvtropes, self.names_imdb, self.ratings,
+                                                self.votes, self.years]))
+        meta_columns = [column for column in columns if column in metadata]
+        trope_columns = [column for column in columns if column not in metadata]
+
+        trope_positions = {name: index for index, name in enumerate(self.trope_names)}
+        selected_positions = [trope_positions[column] for column in trope_columns]
+        trope_values = self.tropes_by_column[:, selected_positions].toarray().astype(np.int64)
+
+        meta_dataframe = pd.DataFrame({column: np.asarray(metadata[column]) for column in meta_columns},
+                                      columns=meta_columns)
+        tropes_dataframe = pd.DataFrame(trope_values, columns=trope_columns)
+        dataframe = pd.concat([meta_dataframe, tropes_dataframe], axis=1)
+        if list(dataframe.columns) != list(columns):
+            dataframe = dataframe[columns]
+        return dataframe
+
+    @staticmethod
+    def _get_trope_indexes(values):
+        flags = ''.join(values)
+        if len(flags) == len(values):
+            return np.flatnonzero(np.frombuffer(flags.encode(), dtype=np.uint8) == ord('1')).astype(np.int32)
+        return [index for index, value in enumerate(values) if value == '1']
+
+    @staticmethod
+    def _build_matrix(indices, indptr, number_of_columns):
+        data = np.ones(len(indices), dtype=np.float64)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, number_of_columns))
+
+    @staticmethod
+    def _to_floats(values):
+        return np.array([float(value) if value != '' else np.nan for value in values], dtype=np.float64)
+
+    @classmethod
+    def _to_metadata_arrays(cls, metadata):
+        ids, names_tvtropes, names_imdb, ratings, votes, years = metadata
+        return [np.array(ids), np.array(names_tvtropes), np.array(names_imdb), cls._to_floats(ratings),
+                cls._to_floats(votes), cls._to_floats(years)]
+
+    def __len__(self):
+        return self.tropes.shape[0]
+
+
+class ExtendedDatasetWriter(object):
+    """
+    Writes films one by one into the directory layout read by ExtendedDataset.load.
+
+    The number of films and of (film, trope) pairs must be known in advance: the trope indexes are written straight
+    into memory-mapped files, so only the metadata of the films is kept in memory until the writer is closed.
+    """
+
+    def __init__(self, directory, trope_names, number_of_films, number_of_values):
+        ExtendedDataset._prepare_directory(directory)
+
+        self.directory = directory
+        self.trope_names = trope_names
+        self.number_of_films = number_of_films
+        self.number_of_values = number_of_values
+
+        self.indices = np.lib.format.open_memmap(os.path.join(directory, 'indices.npy'), mode='w+',
+                                                 dtype=np.int32, shape=(number_of_values,))
+        self.indptr = np.lib.format.open_memmap(os.path.join(directory, 'indptr.npy'), mode='w+',
+                                                dtype=np.int64, shape=(number_of_films + 1,))
+        self.indptr[0] = 0
+        self.metadata = [[] for _ in ExtendedDataset.META_COLUMNS]
+        self.films_written = 0
+
+    def write_film(self, id, name_tvtropes, name_imdb, rating, votes, year, trope_indexes):
+        start = self.indptr[self.films_written]
+        end = start + len(trope_indexes)
+        self.indices[start:end] = trope_indexes
+        self.films_written += 1
+        self.indptr[self.films_written] = end
+
+        for column, value in zip(self.metadata, [id, name_tvtropes, name_imdb, rating, votes, year]):
+            column.append(str(value))
+
+    def close(self):
+        if self.films_written != self.number_of_films or self.indptr[self.films_written] != self.number_of_values:
+            raise ValueError(f'Expected {self.number_of_films} films and {self.number_of_values} tropes, '
+                             f'{self.films_written} films and {self.indptr[self.films_written]} tropes written')
+
+        self.indices.flush()
+        self.indptr.flush()
+        for name, values in zip(ExtendedDataset.METADATA_ARRAYS, ExtendedDataset._to_metadata_arrays(self.metadata)):
+            ExtendedDataset._save_array(self.directory, name, values)
+        ExtendedDataset._save_array(self.directory, 'trope_names', np.array(self.trope_names))
+
+        ExtendedDataset._write_manifest(self.directory, (self.number_of_films, len(self.trope_names)),
+                                        self.number_of_values)
+        del self.indices
+        del self.indptr
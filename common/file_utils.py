@@ -0,0 +1,11 @@
+import hashlib
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
+def get_checksum(file_path: str):
+    checksum = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHECKSUM_CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
@@ -1,3 +1,12 @@
+import re
+
+CAPITALIZED_WORD = re.compile('(.)([A-Z][a-z]+)')
+LOWER_TO_UPPER_CASE = re.compile('([a-z0-9])([A-Z])')
+NOT_ALPHANUMERIC = re.compile('[^a-z0-9 ]+')
+NUMBER_AFTER_CHARACTER = re.compile('([^\\s])([0-9]+)')
+SPACES = re.compile(' +')
+
+
 def humanize_list(list_of_elements: list):
     list_of_texts = [str(element) for element in list_of_elements]
     length = len(list_of_texts)
@@ -9,3 +18,17 @@ def humanize_list(list_of_elements: list):
     first_part = ', '.join(list_of_texts[:-1])
     second_part = list_of_texts[-1]
     return f'{first_part} and {second_part}'
+
+
+def normalize_name(name):
+    """
+    Lowercase words of a film or trope name: CamelCase and numbers are split into words, '&' is read as 'and' and
+    anything else but ASCII letters and digits is removed
+    """
+    name = name.replace('&', ' and ')
+    name = CAPITALIZED_WORD.sub(r'\1 \2', name)
+    name = LOWER_TO_UPPER_CASE.sub(r'\1 \2', name).lower()
+    name = NOT_ALPHANUMERIC.sub('', name)
+    name = NUMBER_AFTER_CHARACTER.sub(r'\1 \2', name)
+    name = SPACES.sub(' ', name)
+    return name
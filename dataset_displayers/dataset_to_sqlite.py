@@ -1,18 +1,50 @@
 import csv
 import os
+import re
 import sqlite3
-
-from tabulate import tabulate
+from itertools import groupby
+from operator import itemgetter
 
 from common.base_script import BaseScript
+from common.compressed_files import open_compressed_file
+from common.string_utils import normalize_name
 
 
 class DatabaseBuilder(BaseScript):
+    """
+    Builds a SQLite database with the films, tropes and tropes by film of an extended dataset (CSV file, optionally
+    compressed with bz2).
+
+    A new database is built from scratch, so it is written in a single transaction without rollback journal nor
+    syncs. Rows are inserted in batches with executemany while the CSV file is read, and the indexes are created once
+    everything is loaded.
+
+    Films and tropes are identified by integer keys. trope_by_film only keeps the (film_id, trope_id) pairs, in a
+    WITHOUT ROWID table clustered by film, with an index clustered by trope for the opposite direction.
+
+    The names of films and tropes are indexed for full-text search in FTS5 tables (trope_search and film_search) that
+    share the ids of their tables. SQLite does not allow custom tokenizers from Python, so names are indexed as they
+    are and split into words (AdaptationDistillation as 'adaptation distillation') with normalize_name.
+
+    The statistics shown for every trope (number of films, average and variance of their ratings, top rated films),
+    film (tropes) and year are kept in summary tables. Films can be appended to an existing database, and then only the
+    summaries of the tropes, films and years they change are refreshed.
+    """
     META_COLUMN_NAME = ['Id', 'NameTvTropes', 'NameIMDB', 'Votes', 'Year']
     RATING_COLUMN_NAME = 'Rating'
     INDEX_FIRST_TROPE = len(META_COLUMN_NAME) + 1
+    BATCH_SIZE = 10000
+    FORMAT_VERSION = 4
+    TOP_FILMS = 10
+    GENRE_PREFIXES = ('genre_', '[GENRE]')
+    QUERY_WORD = re.compile(r'\w+')
+    BUILD_PRAGMAS = ['PRAGMA journal_mode = OFF', 'PRAGMA synchronous = OFF', 'PRAGMA temp_store = MEMORY',
+                     'PRAGMA cache_size = -262144']
 
     def __init__(self, database_file, extended_information_csv_file):
+        parameters = dict(database_file=database_file, extended_information_csv_file=extended_information_csv_file)
+        BaseScript.__init__(self, parameters)
+
         self.database_file = database_file
         self.extended_information_csv_file = extended_information_csv_file
         self.connection = None
@@ -20,7 +52,25 @@ class DatabaseBuilder(BaseScript):
     def build_database(self):
         self._remove_database()
         self._create_database()
-        self._write_database_content()
+        with self.connection:
+            self._write_database_content()
+        self._create_indexes()
+        with self.connection:
+            self._index_new_rows_for_search()
+            self._refresh_summaries()
+        self._finish_and_summary()
+
+    def append_to_database(self):
+        """
+        Adds the films of the CSV file that are not in the database yet, with their tropes, and refreshes the summaries
+        they change
+        """
+        self._open_database()
+        with self.connection:
+            self._write_database_content()
+            self._index_new_rows_for_search()
+            self._refresh_summaries()
+        self._finish_and_summary()
 
     def display_statistics(self):
         if self.connection is None:
@@ -28,64 +78,201 @@ class DatabaseBuilder(BaseScript):
 
         self._show_query('Data imported', ['#different films '], 'SELECT count(*) FROM film')
         self._show_query('Data imported', ['#different tropes'], 'SELECT count(*) FROM trope')
-        self._show_query('Data imported', ['#tropes in films '], 'SELECT count(*) FROM trope_by_film')
+        self._show_query('Data imported', ['#tropes in films '], 'SELECT coalesce(sum(n_tropes), 0) FROM year_summary')
 
         self._show_query('Films by genre:', ['genre', '#films'],
-                         'SELECT trope.name, count(*) '
-                         'FROM trope,trope_by_film '
-                         'where trope.name=trope_by_film.trope and trope.is_genre = "1" '
-                         'group by trope', (), 0, 1000)
+                         'SELECT trope.name, trope_summary.n_films '
+                         'FROM trope JOIN trope_summary ON trope_summary.trope_id = trope.id '
+                         'WHERE trope.is_genre = 1 '
+                         'ORDER BY trope.name', (), 0, 1000)
 
         self._show_query('Tropes by year:', ['year', '#tropes found'],
-                         'SELECT year, count(*) '
-                         'FROM film, trope, trope_by_film '
-                         'where trope.name=trope_by_film.trope and film.name_tvtropes=trope_by_film.film '
-                         'group by year', (), 0, 1000)
+                         'SELECT year, n_tropes FROM year_summary WHERE n_tropes > 0 ORDER BY year', (), 0, 1000)
 
     def _write_database_content(self):
-        with open(self.extended_information_csv_file) as file:
+        """
+        Inserts the tropes and films of the CSV file that are not in the database yet. Their ids are kept in the
+        temporary tables new_trope and new_film.
+        """
+        self.connection.execute('CREATE TEMP TABLE new_trope (id integer PRIMARY KEY)')
+        self.connection.execute('CREATE TEMP TABLE new_film (id integer PRIMARY KEY)')
+        film_names = set(name for name, in self.connection.execute('SELECT name_tvtropes FROM film'))
+        film_id = self.connection.execute('SELECT coalesce(max(id), 0) FROM film').fetchone()[0]
+
+        with open_compressed_file(self.extended_information_csv_file, newline='') as file:
+            reader = csv.reader(file)
             self._track_step(u'Reading first line and extracting information')
-            first_line = file.readline().replace('\n', '')
-
-            columns = first_line.split(',')
-            insert_trope_query = 'INSERT INTO trope(name, is_genre, column_index) VALUES(?, ?, ?)'
-            trope_names = columns[self.INDEX_FIRST_TROPE:]
-            for index, trope_name in enumerate(trope_names):
-                is_genre = 1 if trope_name.startswith('genre_') else 0
-                self.crud(insert_trope_query, (trope_name, is_genre, index))
-                if index % 1000 == 0:
-                    self._track_message('Inserting {} tropes'.format(index))
-
-            insert_film_query = 'INSERT INTO film(name_tvtropes, id_imdb, name_imdb, votes, year, rating) ' \
-                                'VALUES(?, ?, ?, ?, ?, ?)'
-            insert_trope_by_film_query = 'INSERT INTO trope_by_film(film, trope) VALUES(?, ?)'
-
-            line = file.readline()
-            index = 0
-            while line:
-                line = line.replace('\n', '')
-                items = list(csv.reader([line]))[0]
-                id_imdb = items[0]
-                name_tvtropes = items[1]
-                name_imdb = items[2]
-                if items[3] != '':
+            trope_ids = self._insert_tropes(next(reader)[self.INDEX_FIRST_TROPE:])
+
+            films = []
+            tropes_by_film = []
+            inserted_films = 0
+            duplicated_films = 0
+            for index, items in enumerate(reader):
+                id_imdb, name_tvtropes, name_imdb = items[:3]
+                if items[3] != '' and name_tvtropes in film_names:
+                    duplicated_films += 1
+                elif items[3] != '':
                     rating = float(items[3])
                     votes = int(float(items[4]))
                     year = int(float(items[5]))
-                    # print(name_tvtropes)
-                    self.crud(insert_film_query, (name_tvtropes, id_imdb, name_imdb, votes, year, rating))
+                    film_names.add(name_tvtropes)
+                    film_id += 1
+                    inserted_films += 1
+                    films.append((film_id, name_tvtropes, id_imdb, name_imdb, votes, year, rating))
+
+                    trope_indexes = self._get_trope_indexes(items[self.INDEX_FIRST_TROPE:])
+                    tropes_by_film.extend((film_id, trope_ids[trope_index]) for trope_index in trope_indexes)
+
+                if len(films) >= self.BATCH_SIZE or len(tropes_by_film) >= self.BATCH_SIZE:
+                    self._insert_films(films, tropes_by_film)
+                if (index + 1) % 1000 == 0:
+                    self._track_message('Inserting {} films'.format(index + 1))
+            self._insert_films(films, tropes_by_film)
+
+        self._add_to_summary('n_films', inserted_films)
+        self._add_to_summary('n_duplicated_films', duplicated_films)
+
+    @staticmethod
+    def _get_trope_indexes(values):
+        """
+        Columns of a film's tropes. The flags are joined and searched as a string, which is much faster than looking
+        at them one by one in films with a few tropes among thousands of columns.
+        """
+        flags = ''.join(values)
+        if len(flags) != len(values) or '' in values:
+            return [index for index, value in enumerate(values) if value == '1']
+
+        trope_indexes = []
+        index = flags.find('1')
+        while index >= 0:
+            trope_indexes.append(index)
+            index = flags.find('1', index + 1)
+        return trope_indexes
+
+    def _insert_tropes(self, trope_names):
+        """
+        Inserts the tropes not in the database yet and returns the ids of all the tropes, in the order of the columns
+        """
+        ids_by_name = dict(self.connection.execute('SELECT name, id FROM trope'))
+        trope_id, column_index = self.connection.execute(
+            'SELECT coalesce(max(id), 0), coalesce(max(column_index), -1) FROM trope').fetchone()
+
+        new_tropes = []
+        for trope_name in trope_names:
+            if trope_name not in ids_by_name:
+                trope_id += 1
+                column_index += 1
+                ids_by_name[trope_name] = trope_id
+                new_tropes.append((trope_id, trope_name, 1 if trope_name.startswith(self.GENRE_PREFIXES) else 0,
+                                   column_index))
+
+        insert_trope_query = 'INSERT INTO trope(id, name, is_genre, column_index) VALUES(?, ?, ?, ?)'
+        self.connection.executemany(insert_trope_query, new_tropes)
+        self.connection.executemany('INSERT INTO new_trope(id) VALUES(?)', ((trope[0],) for trope in new_tropes))
+        self._add_to_summary('n_tropes', len(new_tropes))
+        return [ids_by_name[trope_name] for trope_name in trope_names]
+
+    def _insert_films(self, films, tropes_by_film):
+        insert_film_query = 'INSERT INTO film(id, name_tvtropes, id_imdb, name_imdb, votes, year, rating) ' \
+                            'VALUES(?, ?, ?, ?, ?, ?, ?)'
+        insert_trope_by_film_query = 'INSERT INTO trope_by_film(film_id, trope_id) VALUES(?, ?)'
+        self.connection.executemany(insert_film_query, films)
+        self.connection.executemany('INSERT INTO new_film(id) VALUES(?)', ((film[0],) for film in films))
+        self.connection.executemany(insert_trope_by_film_query, tropes_by_film)
+        del films[:]
+        del tropes_by_film[:]
 
-                    indices = [i for i, x in enumerate(items[self.INDEX_FIRST_TROPE:]) if x == '1']
-                    for trope_index in indices:
-                        trope_name = trope_names[trope_index]
-                        self.crud(insert_trope_by_film_query, (name_tvtropes, trope_name))
+    def _create_indexes(self):
+        self._track_step('Creating indexes')
+        with self.connection:
+            self.connection.execute('CREATE INDEX trope_by_film_by_trope ON trope_by_film(trope_id, film_id)')
+            self.connection.execute('CREATE INDEX trope_by_genre ON trope(is_genre, name COLLATE NOCASE)')
+            self.connection.execute('CREATE INDEX film_by_year ON film(year)')
+            self.connection.execute('ANALYZE')
+            self.connection.execute(f'PRAGMA user_version = {self.FORMAT_VERSION}')
 
-                line = file.readline()
-                index += 1
-                if index % 100 == 0:
-                    self._track_message('Inserting {} films'.format(index))
+    def _index_new_rows_for_search(self):
+        self._track_step('Indexing new tropes and films for full-text search')
+        for table, columns in [('trope', ['name']), ('film', ['name_tvtropes', 'name_imdb'])]:
+            rows = self.connection.execute(f'SELECT id, {", ".join(columns)} FROM {table} '
+                                           f'WHERE id IN (SELECT id FROM new_{table})').fetchall()
+            self.connection.executemany(f'INSERT INTO {table}_search(rowid, words) VALUES(?, ?)',
+                                        ((row[0], self.get_search_words(*row[1:])) for row in rows))
+            self.connection.execute(f"INSERT INTO {table}_search({table}_search) VALUES('optimize')")
 
-            pass
+    def _refresh_summaries(self):
+        """
+        Recomputes the summaries of the new films, of the tropes that are new or linked to new films, and of the years
+        of the new films
+        """
+        self._track_step('Refreshing summaries')
+        self.connection.execute('CREATE TEMP TABLE changed_trope AS '
+                                'SELECT id FROM new_trope UNION '
+                                'SELECT trope_id FROM trope_by_film WHERE film_id IN (SELECT id FROM new_film)')
+
+        self.connection.execute('''
+            -- the variance is computed in a second pass over the ratings, from their mean, to keep its precision
+            WITH means AS (
+                SELECT trope_by_film.trope_id, count(*) AS n_films, avg(film.rating) AS avg_rating
+                FROM trope_by_film JOIN film ON film.id = trope_by_film.film_id
+                WHERE trope_by_film.trope_id IN (SELECT id FROM changed_trope)
+                GROUP BY trope_by_film.trope_id)
+            INSERT OR REPLACE INTO trope_summary(trope_id, n_films, avg_rating, rating_variance)
+            SELECT means.trope_id, means.n_films, means.avg_rating,
+                   avg((film.rating - means.avg_rating) * (film.rating - means.avg_rating))
+            FROM means
+            JOIN trope_by_film ON trope_by_film.trope_id = means.trope_id
+            JOIN film ON film.id = trope_by_film.film_id
+            GROUP BY means.trope_id''')
+        top_films = self.connection.execute('''
+            SELECT trope_id, name_tvtropes FROM (
+                SELECT trope_by_film.trope_id, film.name_tvtropes,
+                       row_number() OVER (PARTITION BY trope_by_film.trope_id
+                                          ORDER BY film.rating DESC, film.votes DESC, film.name_tvtropes) AS position
+                FROM trope_by_film JOIN film ON film.id = trope_by_film.film_id
+                WHERE trope_by_film.trope_id IN (SELECT id FROM changed_trope))
+            WHERE position <= ?
+            ORDER BY trope_id, position''', (self.TOP_FILMS,)).fetchall()
+        self.connection.executemany('UPDATE trope_summary SET top_films = ? WHERE trope_id = ?', (
+            (', '.join(name for _, name in films), trope_id) for trope_id, films in groupby(top_films, itemgetter(0))))
+
+        tropes_by_film = self.connection.execute('''
+            SELECT trope_by_film.film_id, trope.name
+            FROM trope_by_film JOIN trope ON trope.id = trope_by_film.trope_id
+            WHERE trope_by_film.film_id IN (SELECT id FROM new_film)
+            ORDER BY trope_by_film.film_id, trope.name''').fetchall()
+        self.connection.executemany('INSERT OR REPLACE INTO film_summary(film_id, n_tropes, tropes) VALUES(?, ?, ?)', (
+            (film_id, len(tropes), ', '.join(tropes))
+            for film_id, tropes in ((film_id, [name for _, name in rows])
+                                    for film_id, rows in groupby(tropes_by_film, itemgetter(0)))))
+
+        self.connection.execute('''
+            INSERT OR REPLACE INTO year_summary(year, n_films, n_tropes)
+            SELECT film.year, count(DISTINCT film.id), count(trope_by_film.trope_id)
+            FROM film LEFT JOIN trope_by_film ON trope_by_film.film_id = film.id
+            WHERE film.year IN (SELECT year FROM film WHERE id IN (SELECT id FROM new_film))
+            GROUP BY film.year''')
+
+        for table in ['new_trope', 'new_film', 'changed_trope']:
+            self.connection.execute(f'DROP TABLE temp.{table}')
+
+    @staticmethod
+    def get_search_words(*names):
+        """
+        Text indexed for a film or trope: its names as they are, so a query without spaces matches the whole name, and
+        split into words
+        """
+        return ' '.join(list(names) + [normalize_name(name) for name in names])
+
+    @classmethod
+    def get_match_expression(cls, search_query):
+        """
+        FTS5 query that matches the names with words starting by every word of `search_query`, or None if it has no
+        words
+        """
+        words = cls.QUERY_WORD.findall(search_query)
+        return ' '.join(f'"{word}"*' for word in words) if words else None
 
     def _remove_database(self):
         self._track_step('Removing database')
@@ -94,24 +281,54 @@ class DatabaseBuilder(BaseScript):
         else:
             self._track_message('No database found. Running the script for the first time...')
 
+    def _open_database(self):
+        self._track_step('Opening database')
+        if not os.path.isfile(self.database_file):
+            raise FileNotFoundError(f'Database not found: {self.database_file}')
+
+        self.connection = sqlite3.connect(self.database_file)
+        format_version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if format_version != self.FORMAT_VERSION:
+            raise ValueError(f'{self.database_file} was built with an older version of DatabaseBuilder '
+                             f'(format {format_version}). Please, build it again')
+
     def _create_database(self):
         self._track_step('Creating database')
         self.connection = sqlite3.connect(self.database_file)
+        for pragma in self.BUILD_PRAGMAS:
+            self.connection.execute(pragma)
 
         sql_create_film_table = '''CREATE TABLE IF NOT EXISTS film (
-            name_tvtropes text PRIMARY KEY, id_imdb text NOT NULL, name_imdb text NOT NULL, rating real NOT NULL, 
-            votes integer NOT NULL, year integer NOT_NULL);'''
+            id integer PRIMARY KEY, name_tvtropes text NOT NULL UNIQUE, id_imdb text NOT NULL,
+            name_imdb text NOT NULL, rating real NOT NULL, votes integer NOT NULL, year integer NOT NULL);'''
         self.create_table(sql_create_film_table)
 
         sql_create_trope_table = '''CREATE TABLE IF NOT EXISTS trope (
-            name text PRIMARY KEY, is_genre integer NOT NULL, column_index integer NOT NULL);'''
+            id integer PRIMARY KEY, name text NOT NULL UNIQUE, is_genre integer NOT NULL,
+            column_index integer NOT NULL);'''
         self.create_table(sql_create_trope_table)
 
         sql_create_trope_by_film_table = '''CREATE TABLE IF NOT EXISTS trope_by_film (
-                film text NOT NULL, trope text NOT NULL, 
-                FOREIGN KEY (film) REFERENCES film(name_tvtropes), FOREIGN KEY (trope) REFERENCES trope(name));'''
+                film_id integer NOT NULL REFERENCES film(id), trope_id integer NOT NULL REFERENCES trope(id),
+                PRIMARY KEY (film_id, trope_id)) WITHOUT ROWID;'''
         self.create_table(sql_create_trope_by_film_table)
 
+        for table in ['trope', 'film']:
+            self.create_table(f"CREATE VIRTUAL TABLE {table}_search USING fts5(words, content='', prefix='2 3')")
+
+        sql_create_trope_summary_table = '''CREATE TABLE IF NOT EXISTS trope_summary (
+            trope_id integer PRIMARY KEY REFERENCES trope(id), n_films integer NOT NULL, avg_rating real NOT NULL,
+            rating_variance real NOT NULL, top_films text);'''
+        self.create_table(sql_create_trope_summary_table)
+
+        sql_create_film_summary_table = '''CREATE TABLE IF NOT EXISTS film_summary (
+            film_id integer PRIMARY KEY REFERENCES film(id), n_tropes integer NOT NULL, tropes text NOT NULL);'''
+        self.create_table(sql_create_film_summary_table)
+
+        sql_create_year_summary_table = '''CREATE TABLE IF NOT EXISTS year_summary (
+            year integer PRIMARY KEY, n_films integer NOT NULL, n_tropes integer NOT NULL);'''
+        self.create_table(sql_create_year_summary_table)
+
         self._track_message('Database created')
 
     def create_table(self, create_table_sql):
@@ -121,14 +338,6 @@ class DatabaseBuilder(BaseScript):
         except sqlite3.Error as exception:
             self._track_error(exception)
 
-    def crud(self, sql, arguments):
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute(sql, arguments)
-            self.connection.commit()
-        except sqlite3.Error as exception:
-            self._track_error(exception)
-
 
 if __name__ == "__main__":
     builder = DatabaseBuilder(
@@ -1,63 +1,72 @@
 import sqlite3
 
 from common.base_script import BaseScript
+from dataset_displayers.dataset_to_sqlite import DatabaseBuilder
 
 
 class Displayer(BaseScript):
     def __init__(self, db_file):
         self.connection = sqlite3.connect(db_file)
+        format_version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if format_version != DatabaseBuilder.FORMAT_VERSION:
+            raise ValueError(f'{db_file} was built with an older version of DatabaseBuilder (format {format_version}). '
+                             f'Please, build it again')
+
+    def _get_matches(self, table, search_query):
+        """
+        Returns the query and parameters of the (id, rank) of the rows of `table` matching `search_query` in its
+        full-text search table, or of all its rows when there is nothing to search
+        """
+        match_expression = DatabaseBuilder.get_match_expression(search_query)
+        if match_expression is None:
+            return f'SELECT id, 0 AS rank FROM {table}', ()
+        return f'SELECT rowid AS id, rank FROM {table}_search WHERE {table}_search MATCH ?', (match_expression,)
 
     def search_genres(self, search_query, page=0, results=10):
-        search_query = 'genre_%{}%'.format(search_query)
+        matches, parameters = self._get_matches('trope', search_query)
         self._show_query('', ['genre'],
-                         "SELECT DISTINCT name from trope "
-                         "where name LIKE ? and is_genre='1' "
-                         "order by name "
-                         "COLLATE NOCASE",
-                         (search_query,), page, results)
+                         f"WITH matches AS ({matches}) "
+                         f"SELECT trope.name FROM matches JOIN trope ON trope.id = matches.id "
+                         f"WHERE trope.is_genre = 1 "
+                         f"ORDER BY matches.rank, trope.name COLLATE NOCASE",
+                         parameters, page, results)
 
     def search_tropes(self, search_query, page=0, results=10):
-        search_query = '%{}%'.format(search_query)
-
-        query = '''
-        -- filter tropes by name and sort by number of films and avg_rating
-        SELECT trope_by_film.trope, count(trope_by_film.film) AS n_films, 
-               avg(rating) AS avg_rating, group_concat(trope_by_film.film, ', ')
-        FROM trope_by_film,
-             trope,
-             film
-        WHERE trope_by_film.trope = trope.name
-          AND trope_by_film.film = film.name_tvtropes
-          AND trope_by_film.trope LIKE ? COLLATE NOCASE
-        GROUP BY trope_by_film.trope
-        ORDER BY avg_rating DESC, n_films DESC'''
-
-        self._show_query('', ['trope', '# of films', 'AVG rating'],
-                         query, (search_query,), page, results)
+        matches, parameters = self._get_matches('trope', search_query)
 
+        query = f'''
+        -- filter tropes by name and sort by relevance, avg_rating and number of films
+        WITH matches AS ({matches})
+        SELECT trope.name, trope_summary.n_films, trope_summary.avg_rating, trope_summary.rating_variance,
+               trope_summary.top_films
+        FROM matches
+        JOIN trope ON trope.id = matches.id
+        JOIN trope_summary ON trope_summary.trope_id = trope.id
+        ORDER BY matches.rank, trope_summary.avg_rating DESC, trope_summary.n_films DESC'''
 
+        self._show_query('', ['trope', '# of films', 'AVG rating', 'Rating variance', 'top films'],
+                         query, parameters, page, results)
 
     def search_movies(self, search_query, page=0, results=10):
-        search_query = '%{}%'.format(search_query)
+        matches, parameters = self._get_matches('film', search_query)
 
-        query = '''
-        -- filter tropes by name and sort by number of films and avg_rating
-        SELECT trope_by_film.film, film.name_imdb, film.rating, count(trope_by_film.trope) AS n_tropes, 
-               group_concat(trope_by_film.trope, ', ')
-        FROM trope_by_film,
-             trope,
-             film
-        WHERE trope_by_film.trope = trope.name
-          AND trope_by_film.film = film.name_tvtropes
-          AND (trope_by_film.film LIKE ? COLLATE NOCASE OR film.name_imdb LIKE ? COLLATE NOCASE)
-        GROUP BY trope_by_film.film
-        ORDER BY n_tropes DESC'''
+        query = f'''
+        -- filter films by name and sort by relevance and number of tropes
+        WITH matches AS ({matches})
+        SELECT film.name_tvtropes, film.name_imdb, film.rating, film_summary.n_tropes, film_summary.tropes
+        FROM matches
+        JOIN film ON film.id = matches.id
+        JOIN film_summary ON film_summary.film_id = film.id
+        ORDER BY matches.rank, film_summary.n_tropes DESC'''
 
         self._show_query('', ['Short name', 'Long Name', 'Rating', '# tropes', 'tropes'],
-                         query, (search_query,search_query,), page, results)
+                         query, parameters, page, results)
 
     def list_tropes_by_movie_name(self, film_name):
-        query = 'SELECT trope_by_film.trope FROM trope_by_film WHERE trope_by_film.film = ?'
+        query = 'SELECT trope.name FROM film ' \
+                'JOIN trope_by_film ON trope_by_film.film_id = film.id ' \
+                'JOIN trope ON trope.id = trope_by_film.trope_id ' \
+                'WHERE film.name_tvtropes = ?'
         values = list(self.connection.execute(query, [film_name]))
         values_to_print = ','.join([value[0] for value in values])
 
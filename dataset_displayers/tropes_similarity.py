@@ -1,13 +1,14 @@
 import bz2
 import gzip
-import os
 from collections import namedtuple
-from io import StringIO
 from operator import attrgetter
 
 import pandas as pd
 from pandas._libs import json
 
+from common.compressed_files import load_compressed_json
+from common.extended_dataset import ExtendedDataset
+
 TropesSimilarityEntity = namedtuple('TropesSimilarityEntity', 'name rating n_tropes overlap jaccard common_tropes common_tropes_count')
 
 
@@ -21,15 +22,7 @@ class TropesSimilarityChecker(object):
         self._load_dataframe()
 
     def _load_dataframe(self):
-        self.extended_dataframe = None
-        hdf_name = self.source_extended_dataset.replace('.csv.bz2', '.h5')
-        if os.path.isfile(hdf_name):
-            self.extended_dataframe = pd.read_hdf(hdf_name)
-        else:
-            with open(self.source_extended_dataset, 'rb') as file:
-                compressed_content = file.read()
-            csv_content = bz2.decompress(compressed_content)
-            self.extended_dataframe = pd.read_csv(StringIO(csv_content.decode('utf-8')))
+        self.extended_dataframe = ExtendedDataset.load(self.source_extended_dataset).to_dataframe()
 
     def load_extended_dataset_json(self, source_extended_dataset):
         self.source_extended_dataset = source_extended_dataset
@@ -37,10 +30,7 @@ class TropesSimilarityChecker(object):
 
     def _build_from_json(self):
 
-        with bz2.open(self.source_extended_dataset, "rb") as f:
-            content = f.read()
-        json_bytes = content.decode('utf-8')
-        self.films = json.loads(json_bytes)
+        self.films = load_compressed_json(self.source_extended_dataset)
 
 
     def get_top_films_by_simmilarity(self, trope_list, number_of_results, ignore_genres=False):
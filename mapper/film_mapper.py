@@ -1,24 +1,41 @@
-import bz2
 import csv
 import difflib
-import io
+import gzip
 import json
+import os
 import re
-from collections import OrderedDict
+import sqlite3
+import sys
+from array import array
+from collections import OrderedDict, deque
+from itertools import islice
+from multiprocessing import Pool
+
+import cachetools
+import numpy as np
 
 from common.base_script import BaseScript
+from common.compressed_files import load_compressed_json, open_bz2_writer
+from common.extended_dataset import ExtendedDatasetWriter
+from common.file_utils import get_checksum
+from common.string_utils import normalize_name
 
 
 class MapperUtils(object):
-    @staticmethod
-    def normalize_name(name):
-        name = re.sub('&', ' and ', name)
-        name = re.sub('(.)([A-Z][a-z]+)', r'\1 \2', name)
-        name = re.sub('([a-z0-9])([A-Z])', r'\1 \2', name).lower()
-        name = re.sub('[^a-z0-9 ]+', '', name)
-        name = re.sub('([^\\s])([0-9]+)', r'\1 \2', name)
-        name = re.sub(' +', ' ', name)
-        return name
+    NORMALIZED_NAMES = cachetools.LRUCache(500000)
+
+    @classmethod
+    def normalize_name(cls, name):
+        normalized_name = cls.NORMALIZED_NAMES.get(name, None)
+        if normalized_name is None:
+            normalized_name = normalize_name(name)
+            cls.NORMALIZED_NAMES[name] = normalized_name
+        return normalized_name
+
+    @classmethod
+    def normalize_names(cls, names):
+        normalized_names = {name: cls.normalize_name(name) for name in set(names)}
+        return [normalized_names[name] for name in names]
 
     @staticmethod
     def similarity(source, target):
@@ -27,115 +44,329 @@ class MapperUtils(object):
 
 
 class FilmInIMDB(object):
-    def __init__(self, id, type, title, original_title, is_adult, start_year, end_year, minutes, genres):
+    """
+    Title of the IMDb dataset. Millions of them are kept in memory while mapping films, so the instances have no
+    __dict__, the values repeated across titles (type, years, minutes, genres) are interned and the original title
+    and its normalized name share the title strings when they are equal.
+    """
+    FIELDS = ['id', 'type', 'title', 'original_title', 'is_adult', 'start_year', 'end_year', 'minutes', 'genres',
+              'normalized_title', 'normalized_original_title']
+    __slots__ = FIELDS + ['votes', 'rating']
+    GENRES = {}
+
+    def __init__(self, id, type, title, original_title, is_adult, start_year, end_year, minutes, genres,
+                 normalized_title=None, normalized_original_title=None):
         self.id = id
-        self.type = type
+        self.type = sys.intern(type)
         self.title = title
-        self.original_title = original_title
-        self.is_adult = is_adult
-        self.start_year = start_year
-        self.end_year = end_year
-        self.minutes = minutes
+        self.original_title = title if original_title == title else original_title
+        self.is_adult = sys.intern(is_adult)
+        self.start_year = sys.intern(start_year)
+        self.end_year = sys.intern(end_year)
+        self.minutes = sys.intern(minutes)
         self.genres = self._split_genres(genres)
-        self.normalized_title = MapperUtils.normalize_name(self.title)
-        self.normalized_original_title = MapperUtils.normalize_name(self.original_title)
+        self.normalized_title = normalized_title if normalized_title is not None \
+            else MapperUtils.normalize_name(self.title)
+        self.normalized_original_title = normalized_original_title if normalized_original_title is not None \
+            else MapperUtils.normalize_name(self.original_title)
+        if self.normalized_original_title == self.normalized_title:
+            self.normalized_original_title = self.normalized_title
         self.votes = 0
         self.rating = 0
 
-    @staticmethod
-    def _split_genres(genres):
+    @classmethod
+    def _split_genres(cls, genres):
         if genres is None:
+            return ()
+        split_genres = cls.GENRES.get(genres, None)
+        if split_genres is None:
+            split_genres = tuple(sys.intern(genre) for genre in genres.replace('\n', '').split(','))
+            cls.GENRES[genres] = split_genres
+        return split_genres
+
+    def get_values(self):
+        """
+        Values of the fields in the order of FilmInIMDB(*values), with the genres joined as in title.basics
+        """
+        values = [getattr(self, field) for field in self.FIELDS]
+        values[self.FIELDS.index('genres')] = ','.join(self.genres)
+        return values
+
+
+class ImdbIndex(object):
+    """
+    SQLite file with the IMDb titles considered by the film mapper and the normalized names they can be found by.
+
+    It keeps the checksums of the title.basics and title.ratings files it was built from, so the mapper only parses
+    IMDb again when a new dump is downloaded. Films are looked up by name on demand instead of loaded in memory.
+    """
+    FORMAT_VERSION = 1
+    FILM_COLUMNS = FilmInIMDB.FIELDS + ['votes', 'rating']
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.connection = sqlite3.connect(index_file)
+        self.films_query = f'SELECT {", ".join(f"film.{column}" for column in self.FILM_COLUMNS)} ' \
+                           f'FROM film_by_name JOIN film ON film.row = film_by_name.film ' \
+                           f'WHERE film_by_name.name = ? AND (? IS NULL OR film.start_year = ?) ' \
+                           f'ORDER BY film_by_name.film'
+
+    @staticmethod
+    def get_source_checksums(imdb_titles_file, imdb_ratings_file):
+        return dict(imdb_titles_file=get_checksum(imdb_titles_file),
+                    imdb_ratings_file=get_checksum(imdb_ratings_file))
+
+    @classmethod
+    def is_valid(cls, index_file, source_checksums):
+        if not os.path.isfile(index_file):
+            return False
+
+        connection = sqlite3.connect(index_file)
+        try:
+            format_version = connection.execute('PRAGMA user_version').fetchone()[0]
+            stored_checksums = dict(connection.execute('SELECT source, checksum FROM source'))
+        except sqlite3.Error:
+            return False
+        finally:
+            connection.close()
+        return format_version == cls.FORMAT_VERSION and stored_checksums == source_checksums
+
+    @classmethod
+    def write(cls, index_file, films_in_imdb, films_in_imdb_by_name, source_checksums):
+        temporary_file = f'{index_file}.tmp'
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+        connection = sqlite3.connect(temporary_file)
+        with connection:
+            # Columns without type keep the Python types of the values (e.g. ratings 0 of films without votes)
+            connection.execute(f'CREATE TABLE film (row INTEGER PRIMARY KEY, {", ".join(cls.FILM_COLUMNS)})')
+            connection.execute('CREATE TABLE film_by_name (name TEXT NOT NULL, film INTEGER NOT NULL, '
+                               'PRIMARY KEY (name, film)) WITHOUT ROWID')
+            connection.execute('CREATE TABLE source (source TEXT PRIMARY KEY, checksum TEXT NOT NULL)')
+
+            rows = {film.id: row for row, film in enumerate(films_in_imdb)}
+            connection.executemany(f'INSERT INTO film VALUES (?, {", ".join("?" for _ in cls.FILM_COLUMNS)})',
+                                   ([rows[film.id]] + film.get_values() + [film.votes, film.rating]
+                                    for film in films_in_imdb))
+            connection.executemany('INSERT INTO film_by_name VALUES (?, ?)',
+                                   ((name, rows[film.id]) for name, films in films_in_imdb_by_name.items()
+                                    for film in films))
+            connection.executemany('INSERT INTO source VALUES (?, ?)', source_checksums.items())
+            connection.execute(f'PRAGMA user_version = {cls.FORMAT_VERSION}')
+        connection.close()
+
+        os.replace(temporary_file, index_file)
+
+    def get_names_and_years(self):
+        return self.connection.execute('SELECT DISTINCT film_by_name.name, film.start_year '
+                                       'FROM film_by_name JOIN film ON film.row = film_by_name.film')
+
+    def get_films(self, name, year=None):
+        return [self._to_film(values) for values in self.connection.execute(self.films_query, (name, year, year))]
+
+    def _to_film(self, values):
+        film = FilmInIMDB(*values[:-2])
+        film.votes, film.rating = values[-2:]
+        return film
+
+    def __len__(self):
+        return self.connection.execute('SELECT count(*) FROM film').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class TrigramIndex(object):
+    """
+    Inverted index from the character trigrams of IMDb names to the (name, year) entries containing them.
+
+    The posting lists are stored as a single numpy array sorted by trigram and year, so the index of the whole IMDb
+    dataset fits in a few tens of megabytes and the entries of a year are found by binary search. Shortlisting the
+    names that share most trigrams with a name only reads the rarest posting lists, up to MAX_POSTINGS entries, so
+    common trigrams ('the') do not make every lookup as expensive as the whole dataset.
+    """
+    MAX_POSTINGS = 20000
+
+    def __init__(self, names_and_years):
+        self.names = []
+        self.year_ids = {}
+        years = []
+        entry_year_ids = array('i')
+        self.trigram_ids = {}
+        trigram_ids_of_postings = array('i')
+        entries_of_postings = array('i')
+        for entry, (name, year) in enumerate(names_and_years):
+            self.names.append(name)
+            years.append(year)
+            entry_year_ids.append(self.year_ids.setdefault(year, len(self.year_ids)))
+            for trigram in self.get_trigrams(name):
+                trigram_ids_of_postings.append(self.trigram_ids.setdefault(trigram, len(self.trigram_ids)))
+                entries_of_postings.append(entry)
+
+        trigram_ids_of_postings = np.frombuffer(trigram_ids_of_postings, dtype=np.int32)
+        entries_of_postings = np.frombuffer(entries_of_postings, dtype=np.int32)
+        year_ids_of_postings = np.frombuffer(entry_year_ids, dtype=np.int32)[entries_of_postings]
+        order = np.lexsort((year_ids_of_postings, trigram_ids_of_postings))
+        self.entries = entries_of_postings[order]
+        self.posting_year_ids = year_ids_of_postings[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(trigram_ids_of_postings,
+                                                                 minlength=len(self.trigram_ids)))])
+        self.years = np.array(years)
+
+    @staticmethod
+    def get_trigrams(name):
+        padded_name = f'  {name} '
+        return {padded_name[index:index + 3] for index in range(len(padded_name) - 2)}
+
+    def get_candidates(self, name, year=None, max_candidates=10):
+        if year is not None and year not in self.year_ids:
             return []
-        return genres.replace('\n', '').split(',')
+
+        posting_lists = [self._get_posting_list(self.trigram_ids[trigram], year)
+                         for trigram in self.get_trigrams(name) if trigram in self.trigram_ids]
+        posting_lists = [entries for entries in posting_lists if len(entries)]
+        if not posting_lists:
+            return []
+
+        posting_lists.sort(key=len)
+        rarest_posting_lists = posting_lists[:1]
+        postings = len(posting_lists[0])
+        for entries in posting_lists[1:]:
+            postings += len(entries)
+            if postings > self.MAX_POSTINGS:
+                break
+            rarest_posting_lists.append(entries)
+
+        entries = np.concatenate(rarest_posting_lists)[:self.MAX_POSTINGS]
+        candidates, shared_trigrams = np.unique(entries, return_counts=True)
+        best_candidates = candidates[np.argsort(-shared_trigrams, kind='stable')[:max_candidates]]
+        return [(self.names[entry], self.years[entry]) for entry in best_candidates]
+
+    def _get_posting_list(self, trigram_id, year=None):
+        start, end = self.indptr[trigram_id], self.indptr[trigram_id + 1]
+        if year is not None:
+            year_ids = self.posting_year_ids[start:end]
+            year_id = self.year_ids[year]
+            start, end = start + np.searchsorted(year_ids, year_id), start + np.searchsorted(year_ids, year_id, 'right')
+        return self.entries[start:end]
+
+    def __len__(self):
+        return len(self.names)
 
 
 class FilmMapper(BaseScript):
+    META_COLUMNS = ['Id', 'NameTvTropes', 'NameIMDB', 'Rating', 'Votes', 'Year']
+    SPARSE_EXTENSION = '.sparse'
+    MAPPING_EXTENSION = '.mapping.json.bz2'
     EXCLUDED_ENTRY_TYPES = ['tvEpisode', 'tvSeries', 'tvSpecial', 'tvShort', 'videoGame', 'tvMiniSeries',
                             'titleType']
     INCLUDE_FILMS_FROM_IMDB_WITHOUT_YEAR = False
-
-    def __init__(self, tvtropes_films_file, imdb_titles_file, imdb_ratings_file, target_dataset, remove_ambiguities):
+    IMDB_ENCODING = 'utf-8'
+    IMDB_TITLE_COLUMNS = 9
+    IMDB_CHUNK_SIZE = 50000
+    IMDB_CHUNKS_WAITING_PER_WORKER = 2
+    FUZZY_CANDIDATES = 10
+    FUZZY_MINIMUM_SIMILARITY = 90
+
+    def __init__(self, tvtropes_films_file, imdb_titles_file, imdb_ratings_file, target_dataset, remove_ambiguities,
+                 export_csv=False, workers=None, imdb_index_file=None, fuzzy_matching=False,
+                 previous_mapping_file=None):
         parameters = dict(tvtropes_films_file_name=tvtropes_films_file, imdb_titles_file=imdb_titles_file,
                           imdb_ratings_file=imdb_ratings_file, target_dataset=target_dataset,
                           excluded_entry_types=self.EXCLUDED_ENTRY_TYPES,
                           include_films_from_imdb_without_year=self.INCLUDE_FILMS_FROM_IMDB_WITHOUT_YEAR,
-                          remove_ambiguities=remove_ambiguities)
+                          remove_ambiguities=remove_ambiguities, export_csv=export_csv, workers=workers,
+                          imdb_index_file=imdb_index_file, fuzzy_matching=fuzzy_matching,
+                          fuzzy_candidates=self.FUZZY_CANDIDATES,
+                          fuzzy_minimum_similarity=self.FUZZY_MINIMUM_SIMILARITY,
+                          previous_mapping_file=previous_mapping_file)
 
         BaseScript.__init__(self, parameters)
 
         self.tvtropes_films_file = tvtropes_films_file
         self.imdb_titles_file = imdb_titles_file
         self.imdb_ratings_file = imdb_ratings_file
-        self.target_dataset_without_extension = target_dataset.split('.')[0]
+        self.target_dataset_without_extension = target_dataset.split('.')[0] if target_dataset else None
         self.remove_ambiguities = remove_ambiguities
+        self.export_csv = export_csv
+        self.workers = workers
+        self.imdb_index_file = imdb_index_file
+        self.imdb_index = None
+        self.fuzzy_matching = fuzzy_matching
+        self.previous_mapping_file = previous_mapping_file
+        self.previous_imdb_map = {}
 
         self.film_list = []
         self.films_in_imdb = []
         self.films_in_imdb_hash = {}
 
     def run(self):
-        self._load_information_from_imdb_dataset()
         self._load_information_from_tvtropes_dataset()
+        self._load_previous_mapping()
+        if self._get_films_to_match():
+            self._load_information_from_imdb_dataset()
+        if self.imdb_index is not None or not self._get_films_to_match():
+            # title.ratings was not read while loading IMDb
+            self._refresh_ratings_of_previous_matches()
         self._map_films()
         self._write_dataset()
         self._finish_and_summary()
 
+    def build_imdb_index(self):
+        self._load_information_from_imdb_dataset()
+        self._finish_and_summary()
+
     def _load_information_from_imdb_dataset(self):
+        if self.imdb_index_file is None:
+            self._parse_imdb_dataset()
+            return
+
+        source_checksums = ImdbIndex.get_source_checksums(self.imdb_titles_file, self.imdb_ratings_file)
+        if ImdbIndex.is_valid(self.imdb_index_file, source_checksums):
+            self._info(f'Using the IMDb index built from the same IMDb files: {self.imdb_index_file}')
+            self.imdb_index = ImdbIndex(self.imdb_index_file)
+            self._add_to_summary('imdb_films_considered', len(self.imdb_index))
+        else:
+            self._parse_imdb_dataset()
+            self._info(f'Writing the IMDb index: {self.imdb_index_file}')
+            ImdbIndex.write(self.imdb_index_file, self.films_in_imdb, self.films_in_imdb_by_name, source_checksums)
+        self._add_to_summary('imdb_index_file', self.imdb_index_file)
+
+    def _parse_imdb_dataset(self):
         self.films_in_imdb = []
         self.films_in_imdb_by_id = {}
-        self.films_in_imdb_by_year = {}
         self.films_in_imdb_by_name = {}
         types = set()
 
         self._info(f'Loading basic information from IMDb dataset: {self.imdb_titles_file}')
-        with open(self.imdb_titles_file, 'r', encoding='utf-8') as films_imdb_titles:
-            imdb_lines_counter = 0
-            for line in films_imdb_titles:
-                try:
-                    components = line.split('\t')
-                    types.add(components[1])
-                    if self._is_included_due_type(components) and self._is_included_due_start_year(components):
-                        film_in_imdb = FilmInIMDB(*components)
-
-                        self.films_in_imdb.append(film_in_imdb)
-
-                        year = film_in_imdb.start_year
-                        name = film_in_imdb.normalized_title
-                        original_name = film_in_imdb.normalized_original_title
-
-                        self.films_in_imdb_by_id[film_in_imdb.id] = film_in_imdb
-
-                        if not year in self.films_in_imdb_by_year:
-                            self.films_in_imdb_by_year[year] = {}
-                        if not name in self.films_in_imdb_by_year[year]:
-                            self.films_in_imdb_by_year[year][name] = []
-                        self.films_in_imdb_by_year[year][name].append(film_in_imdb)
-                        if not original_name in self.films_in_imdb_by_year[year]:
-                            self.films_in_imdb_by_year[year][original_name] = []
-                        if film_in_imdb not in self.films_in_imdb_by_year[year][original_name]:
-                            self.films_in_imdb_by_year[year][original_name].append(film_in_imdb)
-
-                        if not name in self.films_in_imdb_by_name:
-                            self.films_in_imdb_by_name[name] = []
-                        self.films_in_imdb_by_name[name].append(film_in_imdb)
-                        if not original_name in self.films_in_imdb_by_name:
-                            self.films_in_imdb_by_name[original_name] = []
-                        if film_in_imdb not in self.films_in_imdb_by_name[original_name]:
-                            self.films_in_imdb_by_name[original_name].append(film_in_imdb)
-
-                        if len(self.films_in_imdb) % 50000 == 0:
-                            self._info(f'{len(self.films_in_imdb)} films read')
-
-                except Exception as exception:
-                    self._track_error(f'Exception in line {line}. {exception}')
-                finally:
-                    imdb_lines_counter += 1
-
-            self._add_to_summary('imdb_lines_counter', imdb_lines_counter)
-            self._add_to_summary('imdb_films_considered', len(self.films_in_imdb))
-
+        imdb_lines_counter = 0
+        with self._open_imdb_file(self.imdb_titles_file) as films_imdb_titles:
+            for lines_in_chunk, types_in_chunk, parsed_films, errors in self._parse_titles(films_imdb_titles):
+                imdb_lines_counter += lines_in_chunk
+                types.update(types_in_chunk)
+                for error in errors:
+                    self._track_error(error)
+
+                films_read_before = len(self.films_in_imdb)
+                for components, normalized_title, normalized_original_title in parsed_films:
+                    self._add_film_in_imdb(FilmInIMDB(*components, normalized_title=normalized_title,
+                                                      normalized_original_title=normalized_original_title))
+                if len(self.films_in_imdb) // 50000 > films_read_before // 50000:
+                    self._info(f'{len(self.films_in_imdb)} films read')
+
+        self._add_to_summary('imdb_lines_counter', imdb_lines_counter)
+        self._add_to_summary('imdb_films_considered', len(self.films_in_imdb))
+
+        self._add_ratings(self.films_in_imdb_by_id, self._get_previous_films_by_id())
+
+    def _add_ratings(self, *films_by_id_dictionaries):
+        """
+        Sets the rating and votes of the films of every {IMDb id: film} dictionary in a single pass over title.ratings
+        """
+        films_by_id_dictionaries = [films_by_id for films_by_id in films_by_id_dictionaries if films_by_id]
         self._info(f'Adding ratings and votes from IMDb dataset: {self.imdb_ratings_file}')
-        with open(self.imdb_ratings_file, 'r') as films_imdb_ratings:
+        with self._open_imdb_file(self.imdb_ratings_file) as films_imdb_ratings:
             for line in films_imdb_ratings:
                 try:
                     components = line.split('\t')
@@ -143,38 +374,133 @@ class FilmMapper(BaseScript):
                     rating = components[1]
                     votes = components[2]
 
-                    if id in self.films_in_imdb_by_id:
-                        self.films_in_imdb_by_id[id].rating = float(rating)
-                        self.films_in_imdb_by_id[id].votes = float(votes)
+                    for films_by_id in films_by_id_dictionaries:
+                        if id in films_by_id:
+                            films_by_id[id].rating = float(rating)
+                            films_by_id[id].votes = float(votes)
 
                 except Exception as exception:
                     self._track_error(f'Exception in line {line}. {exception}')
 
-    def _is_included_due_type(self, components):
-        return components[1] not in self.EXCLUDED_ENTRY_TYPES
+    @classmethod
+    def _open_imdb_file(cls, file_path):
+        opener = gzip.open if file_path.endswith('.gz') else open
+        return opener(file_path, 'rt', encoding=cls.IMDB_ENCODING)
+
+    def _parse_titles(self, films_imdb_titles):
+        """
+        Yields the parsed chunks of title.basics in order. The file is streamed: at most IMDB_CHUNKS_WAITING_PER_WORKER
+        chunks per worker are read ahead of the one being consumed.
+        """
+        chunks = iter(lambda: list(islice(films_imdb_titles, self.IMDB_CHUNK_SIZE)), [])
+        arguments = ((chunk, self.EXCLUDED_ENTRY_TYPES, self.INCLUDE_FILMS_FROM_IMDB_WITHOUT_YEAR)
+                     for chunk in chunks)
+        if self.workers == 1:
+            yield from map(self._parse_titles_chunk, arguments)
+            return
+
+        processes = self.workers or os.cpu_count()
+        with Pool(processes=processes) as pool:
+            pending_chunks = deque()
+            for chunk_arguments in arguments:
+                pending_chunks.append(pool.apply_async(self._parse_titles_chunk, (chunk_arguments,)))
+                while len(pending_chunks) > self.IMDB_CHUNKS_WAITING_PER_WORKER * processes:
+                    yield pending_chunks.popleft().get()
+            while pending_chunks:
+                yield pending_chunks.popleft().get()
 
-    def _is_included_due_start_year(self, components):
-        return self.INCLUDE_FILMS_FROM_IMDB_WITHOUT_YEAR or len(components[5]) == 4
+    @staticmethod
+    def _parse_titles_chunk(arguments):
+        """
+        Runs in a worker process: filters the lines of a chunk of title.basics and normalizes the titles of the films
+        included, which is the expensive part of loading IMDb.
+        """
+        lines, excluded_entry_types, include_films_without_year = arguments
+        types = set()
+        included_films = []
+        errors = []
+        for line in lines:
+            try:
+                components = line.split('\t')
+                if len(components) != FilmMapper.IMDB_TITLE_COLUMNS:
+                    errors.append(f'Exception in line {line}. Expected {FilmMapper.IMDB_TITLE_COLUMNS} columns, '
+                                  f'found {len(components)}')
+                    continue
+
+                types.add(components[1])
+                if components[1] not in excluded_entry_types and \
+                        (include_films_without_year or len(components[5]) == 4):
+                    included_films.append((components, components[2], components[3]))
+            except Exception as exception:
+                errors.append(f'Exception in line {line}. {exception}')
+
+        titles = MapperUtils.normalize_names([title for _, title, _ in included_films])
+        original_titles = MapperUtils.normalize_names([original_title for _, _, original_title in included_films])
+        parsed_films = [(components, title, original_title) for (components, _, _), title, original_title
+                        in zip(included_films, titles, original_titles)]
+        return len(lines), types, parsed_films, errors
+
+    def _add_film_in_imdb(self, film_in_imdb):
+        self.films_in_imdb.append(film_in_imdb)
+        self.films_in_imdb_by_id[film_in_imdb.id] = film_in_imdb
+
+        name = film_in_imdb.normalized_title
+        original_name = film_in_imdb.normalized_original_title
+
+        self.films_in_imdb_by_name.setdefault(name, []).append(film_in_imdb)
+        if original_name != name:
+            self.films_in_imdb_by_name.setdefault(original_name, []).append(film_in_imdb)
 
     def _load_information_from_tvtropes_dataset(self):
-        with open(self.tvtropes_films_file, 'r') as films_tvtropes:
-            self.tropes_by_film = json.load(films_tvtropes)
+        self.tropes_by_film = load_compressed_json(self.tvtropes_films_file)
+
+    def _load_previous_mapping(self):
+        """
+        Films of the previous mapping keep their IMDb matches, so only the films added (or renamed) in TVTropes since
+        then are looked up in IMDb. Their tropes always come from the new TVTropes file.
+        """
+        self.previous_imdb_map = {}
+        if self.previous_mapping_file is None:
+            return
+
+        self._info(f'Loading the previous mapping: {self.previous_mapping_file}')
+        values_by_film = load_compressed_json(self.previous_mapping_file)
+
+        films_by_id = {}
+        for film_name_tvtropes, films_values in values_by_film.items():
+            if film_name_tvtropes in self.tropes_by_film:
+                self.previous_imdb_map[film_name_tvtropes] = [
+                    films_by_id.setdefault(values[0], FilmInIMDB(*values)) for values in films_values]
+
+        self._add_to_summary('Films reused from the previous mapping', len(self.previous_imdb_map))
+        self._add_to_summary('Films removed since the previous mapping',
+                             len(values_by_film) - len(self.previous_imdb_map))
+        self._add_to_summary('Films to match', len(self._get_films_to_match()))
+
+    def _get_films_to_match(self):
+        return [film_name for film_name in self.tropes_by_film if film_name not in self.previous_imdb_map]
+
+    def _get_previous_films_by_id(self):
+        return {film.id: film for films in self.previous_imdb_map.values() for film in films}
+
+    def _refresh_ratings_of_previous_matches(self):
+        films_by_id = self._get_previous_films_by_id()
+        if films_by_id:
+            self._add_ratings(films_by_id)
 
     def _map_films(self):
         self.tvtropes_imdb_map = {}
 
         for film_name_tvtropes in self.tropes_by_film:
-            self.tvtropes_imdb_map[film_name_tvtropes] = []
-
-            if self._contains_year(film_name_tvtropes):
-                year = film_name_tvtropes[-4:]
-                name = MapperUtils.normalize_name(film_name_tvtropes[:-4])
-                if year in self.films_in_imdb_by_year and name in self.films_in_imdb_by_year[year]:
-                    self.tvtropes_imdb_map[film_name_tvtropes].extend(self.films_in_imdb_by_year[year][name])
+            if film_name_tvtropes in self.previous_imdb_map:
+                self.tvtropes_imdb_map[film_name_tvtropes] = list(self.previous_imdb_map[film_name_tvtropes])
             else:
-                name = MapperUtils.normalize_name(film_name_tvtropes)
-                if name in self.films_in_imdb_by_name:
-                    self.tvtropes_imdb_map[film_name_tvtropes].extend(self.films_in_imdb_by_name[name])
+                name, year = self._get_name_and_year(film_name_tvtropes)
+                self.tvtropes_imdb_map[film_name_tvtropes] = list(self._get_films_in_imdb(name, year))
+
+        if self.fuzzy_matching:
+            self._map_films_by_similar_names()
+        self.imdb_matches = dict(self.tvtropes_imdb_map)
 
         self._add_to_summary('Films matched times: 0', len(self._matches_equal(0)))
         self._add_to_summary('Films matched times: 1', len(self._matches_equal(1)))
@@ -191,6 +517,55 @@ class FilmMapper(BaseScript):
                     self.tvtropes_imdb_map[key] = sorted_films_by_popularity[0:1]
             self._add_to_summary('Films matched times: 1 (remove ambiguity)', len(self._matches_equal(1)))
 
+    def _map_films_by_similar_names(self):
+        films_not_found = [film_name for film_name in self._matches_equal(0)
+                           if film_name not in self.previous_imdb_map]
+        if not films_not_found:
+            return
+
+        self._info(f'Looking for IMDb films with names similar to {len(films_not_found)} films not found')
+        trigram_index = TrigramIndex(self._get_imdb_names_and_years())
+        self._info(f'Trigram index built with {len(trigram_index)} IMDb names')
+
+        films_matched = 0
+        for film_name_tvtropes in films_not_found:
+            name, year = self._get_name_and_year(film_name_tvtropes)
+            best_similarity = 0
+            best_candidate = None
+            for candidate in trigram_index.get_candidates(name, year, self.FUZZY_CANDIDATES):
+                similarity = MapperUtils.similarity(name, candidate[0])
+                if similarity > best_similarity:
+                    best_similarity = similarity
+                    best_candidate = candidate
+
+            if best_candidate is not None and best_similarity >= self.FUZZY_MINIMUM_SIMILARITY:
+                candidate_name, candidate_year = best_candidate
+                self.tvtropes_imdb_map[film_name_tvtropes] = list(
+                    self._get_films_in_imdb(candidate_name, candidate_year if year is not None else None))
+                self._info(f'{film_name_tvtropes} matched with "{candidate_name}" (similarity {best_similarity:.1f})')
+                films_matched += 1
+
+        self._add_to_summary('Films matched by similar names', films_matched)
+
+    def _get_imdb_names_and_years(self):
+        if self.imdb_index is not None:
+            return self.imdb_index.get_names_and_years()
+
+        return ((name, year) for name, films in self.films_in_imdb_by_name.items()
+                for year in OrderedDict.fromkeys(film.start_year for film in films))
+
+    def _get_name_and_year(self, film_name_tvtropes):
+        if self._contains_year(film_name_tvtropes):
+            return MapperUtils.normalize_name(film_name_tvtropes[:-4]), film_name_tvtropes[-4:]
+        return MapperUtils.normalize_name(film_name_tvtropes), None
+
+    def _get_films_in_imdb(self, name, year=None):
+        if self.imdb_index is not None:
+            return self.imdb_index.get_films(name, year)
+
+        films = self.films_in_imdb_by_name.get(name, [])
+        return films if year is None else [film for film in films if film.start_year == year]
+
     def safe_division(self, x, y):
         if y == 0:
             return 0
@@ -208,75 +583,117 @@ class FilmMapper(BaseScript):
 
     def _write_dataset(self):
         films_matched = self._matches_equal(1)
+        self._write_json(films_matched)
+        self._write_mapping()
+
+        trope_names = self._build_vocabulary()
+        self._write_sparse_dataset(films_matched, trope_names)
+        if self.export_csv:
+            self._write_csv(films_matched, trope_names)
 
+    def _write_json(self, films_matched):
         self._info('Writing to a JSON file')
-        list_to_store = []
-        for film_name in films_matched:
-            film = self.tvtropes_imdb_map[film_name][0]
-            film_tropes = self.tropes_by_film[film_name]
-
-            film_dictionary = OrderedDict()
-            film_dictionary['id'] = film.id
-            film_dictionary['name'] = film_name
-            film_dictionary['title'] = film.title
-            film_dictionary['rating'] = film.rating
-            film_dictionary['votes'] = film.votes
-            film_dictionary['start_year'] = film.start_year
-            film_dictionary['tropes'] = sorted(list(film_tropes))
-            film_dictionary['genres'] = sorted(list(film.genres))
-            list_to_store.append(film_dictionary)
-
-        self.json_content = json.dumps(list_to_store)
-        self._add_to_summary('uncompressed_generated_json_file_size_bytes', len(self.json_content))
         json_compressed_path = f'{self.target_dataset_without_extension}.json.bz2'
-        self.json_compressed_content = bz2.compress(self.json_content.encode('UTF-8'))
-        with open(json_compressed_path, 'wb') as compressed_file:
-            compressed_file.write(self.json_compressed_content)
-
+        with open_bz2_writer(json_compressed_path) as compressed_file:
+            compressed_file.write('[')
+            for index, film_name in enumerate(films_matched):
+                if index:
+                    compressed_file.write(', ')
+                compressed_file.write(json.dumps(self._get_film_dictionary(film_name)))
+            compressed_file.write(']')
+
+        self._add_to_summary('uncompressed_generated_json_file_size_bytes', compressed_file.buffer.uncompressed_size)
         self._add_to_summary('compressed_generated_json_file_path', json_compressed_path)
-        self._add_to_summary('compressed_generated_json_file_size_bytes', len(self.json_compressed_content))
+        self._add_to_summary('compressed_generated_json_file_size_bytes', compressed_file.buffer.compressed_size)
 
+    def _get_film_dictionary(self, film_name):
+        film = self.tvtropes_imdb_map[film_name][0]
+        film_tropes = self.tropes_by_film[film_name]
 
-        self._info('Writing to a CSV file')
+        film_dictionary = OrderedDict()
+        film_dictionary['id'] = film.id
+        film_dictionary['name'] = film_name
+        film_dictionary['title'] = film.title
+        film_dictionary['rating'] = film.rating
+        film_dictionary['votes'] = film.votes
+        film_dictionary['start_year'] = film.start_year
+        film_dictionary['tropes'] = sorted(list(film_tropes))
+        film_dictionary['genres'] = sorted(list(film.genres))
+        return film_dictionary
+
+    def _write_mapping(self):
+        mapping_path = f'{self.target_dataset_without_extension}{self.MAPPING_EXTENSION}'
+        self._info(f'Writing the IMDb films matched by every TVTropes film: {mapping_path}')
+        values_by_film = {film_name: [film.get_values() for film in films]
+                          for film_name, films in self.imdb_matches.items()}
+        with open_bz2_writer(mapping_path) as mapping:
+            json.dump(values_by_film, mapping)
+
+        self._add_to_summary('mapping_generated_file_path', mapping_path)
+
+    def _build_vocabulary(self):
         all_tropes_in_order = sorted(set([trope for tropes in self.tropes_by_film.values() for trope in tropes]))
         all_genres_in_order = sorted(set([genre for films in self.tvtropes_imdb_map.values()
                                           if len(films) for genre in films[0].genres]))
 
-        output = io.StringIO()
-        writer = csv.writer(output)
-        header = self.get_header(all_tropes_in_order, all_genres_in_order)
-        writer.writerow(header)
-        number_of_rows = 0
-        for film in films_matched:
-            row = self.get_row_for_film(film, all_tropes_in_order, all_genres_in_order)
-            writer.writerow(row)
-            number_of_rows += 1
-            if number_of_rows % 500 == 0:
-                self._info(f'{number_of_rows} rows written')
-
-        self.uncompressed_content = output.getvalue()
-        self._add_to_summary('uncompressed_generated_csv_file_size_bytes', len(self.uncompressed_content))
+        trope_names = self.get_header(all_tropes_in_order, all_genres_in_order)[len(self.META_COLUMNS):]
+        self.trope_positions = {trope_name: index for index, trope_name in enumerate(trope_names)}
+        return trope_names
 
-        compressed_path = f'{self.target_dataset_without_extension}.csv.bz2'
-        self.compressed_content = bz2.compress(self.uncompressed_content.encode('UTF-8'))
-        with open(compressed_path, 'wb') as compressed_file:
-            compressed_file.write(self.compressed_content)
+    def _write_sparse_dataset(self, films_matched, trope_names):
+        sparse_path = f'{self.target_dataset_without_extension}{self.SPARSE_EXTENSION}'
+        self._info(f'Writing films and tropes as a sparse dataset: {sparse_path}')
 
-        self._add_to_summary('compressed_generated_csv_file_path', compressed_path)
-        self._add_to_summary('compressed_generated_csv_file_size_bytes', len(self.compressed_content))
+        number_of_values = sum(len(self.get_trope_indexes_for_film(film_name)) for film_name in films_matched)
 
+        writer = ExtendedDatasetWriter(sparse_path, trope_names, len(films_matched), number_of_values)
+        for film_name in films_matched:
+            film = self.tvtropes_imdb_map[film_name][0]
+            writer.write_film(film.id, film_name, film.title, film.rating, film.votes, film.start_year,
+                              self.get_trope_indexes_for_film(film_name))
+        writer.close()
+
+        self._add_to_summary('sparse_generated_dataset_path', sparse_path)
+        self._add_to_summary('sparse_generated_dataset_values', number_of_values)
+
+    def _write_csv(self, films_matched, trope_names):
+        self._info('Writing to a CSV file')
+        compressed_path = f'{self.target_dataset_without_extension}.csv.bz2'
+        with open_bz2_writer(compressed_path) as compressed_file:
+            writer = csv.writer(compressed_file)
+            writer.writerow(self.META_COLUMNS + trope_names)
+            number_of_rows = 0
+            for film in films_matched:
+                row = self.get_row_for_film(film, len(trope_names))
+                writer.writerow(row)
+                number_of_rows += 1
+                if number_of_rows % 500 == 0:
+                    self._info(f'{number_of_rows} rows written')
+
+        self._add_to_summary('uncompressed_generated_csv_file_size_bytes', compressed_file.buffer.uncompressed_size)
+        self._add_to_summary('compressed_generated_csv_file_path', compressed_path)
+        self._add_to_summary('compressed_generated_csv_file_size_bytes', compressed_file.buffer.compressed_size)
 
     def get_header(self, tropes, genres):
-        row = ['Id', 'NameTvTropes', 'NameIMDB', 'Rating', 'Votes', 'Year']
+        row = list(self.META_COLUMNS)
         row.extend([trope for trope in tropes])
         row.extend([f'[GENRE]{genre}' for genre in genres])
         return row
 
-    def get_row_for_film(self, film_name, all_tropes, all_genres):
+    def get_trope_indexes_for_film(self, film_name):
         film = self.tvtropes_imdb_map[film_name][0]
         film_tropes = self.tropes_by_film[film_name]
 
+        trope_names = set(film_tropes).union([f'[GENRE]{genre}' for genre in film.genres])
+        return sorted(self.trope_positions[trope_name] for trope_name in trope_names)
+
+    def get_row_for_film(self, film_name, number_of_tropes):
+        film = self.tvtropes_imdb_map[film_name][0]
+
+        flags = ['0'] * number_of_tropes
+        for index in self.get_trope_indexes_for_film(film_name):
+            flags[index] = '1'
+
         row = [film.id, film_name, film.title, film.rating, film.votes, film.start_year]
-        row.extend([1 if trope in film_tropes else 0 for trope in all_tropes])
-        row.extend([1 if genre in film.genres else 0 for genre in all_genres])
+        row.extend(flags)
         return row
@@ -1,10 +1,8 @@
-import bz2
 import csv
 import json
 import os
 import sys
 import textwrap
-from io import StringIO
 from pandas import DataFrame
 from random import Random
 import os
@@ -18,6 +16,8 @@ import math
 
 import sys
 
+from common.compressed_files import load_compressed_json
+from common.extended_dataset import ExtendedDataset
 from dataset_displayers.similarity_utils import get_jaccard_similarity, get_common_tropes_similarity
 from rating_evaluator.neural_network_tropes_evaluator import NeuralNetworkTropesEvaluator
 
@@ -32,10 +32,7 @@ def read_compressed_json(file_path):
     if file_path in data:
         return data[file_path]
 
-    with open(file_path, 'rb') as file:
-        compressed_content = file.read()
-    content_bytes = bz2.decompress(compressed_content)
-    content = json.loads(content_bytes.decode('utf-8'))
+    content = load_compressed_json(file_path)
 
     data[file_path] = content
     return content
@@ -143,25 +140,16 @@ def get_experiment_execution_information(log_file_path):
     return input_dataframe, output_dataframe
 
 
-def read_dataframe(file_path, use_hdf=True):
-    if file_path in data:
-        return data[file_path]
+def read_dataframe(file_path, use_cache=True, columns=None):
+    key = (file_path, tuple(columns) if columns is not None else None)
+    if key in data:
+        return data[key]
 
+    content = None
     if file_path.endswith('csv.bz2'):
-        content = None
-
-        file_hdf = file_path.replace('csv.bz2', 'h5')
-        if os.path.isfile(file_hdf):
-            content = pd.read_hdf(file_hdf)
-        else:
-            with open(file_path, 'rb') as file:
-                compressed_content = file.read()
-            csv_content = bz2.decompress(compressed_content)
-            content = pd.read_csv(StringIO(csv_content.decode('utf-8')))
-            if use_hdf:
-                content.to_hdf(file_hdf, 'tripdata')
+        content = ExtendedDataset.load(file_path, use_cache).to_dataframe(columns)
 
-    data[file_path] = content
+    data[key] = content
     return content
 
 
@@ -205,19 +193,14 @@ def extract_iterations_from_log(log_file_name):
     return pd.DataFrame(values)
 
 def extract_grid_parameters_from_log_and_results(log_file_name):
-    result_line = '^.*\\| Result: [^\{]*(.*)$'
+    result_prefix = '| Result: '
 
     values = []
     with open(log_file_name, 'r') as scraper_log:
         lines = scraper_log.readlines()
-    import re
     for line in lines:
-        matches = re.search(result_line, line)
-        if matches:
-            text = matches.group(1)
-            text = re.sub("'hidden_layer_sizes': \\(([^\\)]*)\\)", "'hidden_layer_sizes': '(\\1)'", text)
-            text = text.replace('\'','"')
-            entry = json.loads(text)
+        if result_prefix in line:
+            entry = _parse_grid_result(line.split(result_prefix, 1)[1])
             entry = {key.replace('_',' '):value for key,value in entry.items()}
             values.append(entry)
     dataframe = pd.DataFrame(values)
@@ -226,6 +209,22 @@ def extract_grid_parameters_from_log_and_results(log_file_name):
     return dataframe
 
 
+def _parse_grid_result(text):
+    try:
+        entry = json.loads(text)
+        entry['hidden_layer_sizes'] = str(tuple(entry['hidden_layer_sizes']))
+        return entry
+    except ValueError:
+        pass
+
+    # Logs written before the results were stored as JSON: "<mean> (+/-<std>) for <python dictionary>"
+    import re
+    text = text[text.index('{'):]
+    text = re.sub("'hidden_layer_sizes': \\(([^\\)]*)\\)", "'hidden_layer_sizes': '(\\1)'", text)
+    text = text.replace('\'','"')
+    return json.loads(text)
+
+
 def human_readable(value):
     if isinstance(value, float):
         print ("{0:.3f}".format(value))
@@ -341,10 +340,7 @@ def get_top_film_dna_as_table(recommender_details_log, max = 100):
 
 def get_random_synthetic_film_dna(evaluator_file, extended_dataset_file, n_films=5, film_length=30, seed=0):
     evaluator = NeuralNetworkTropesEvaluator(evaluator_file)
-    with bz2.open(extended_dataset_file, "rb") as f:
-        content = f.read()
-    json_bytes = content.decode('utf-8')
-    films = json.loads(json_bytes)
+    films = load_compressed_json(extended_dataset_file)
     all_tropes_in_list = set()
     for film in films:
         all_tropes_in_list.update(set(film['tropes']))
@@ -1,30 +1,48 @@
 from __future__ import print_function
 
-import bz2
 import logging
 import math
 import os
-from io import StringIO
 
 import joblib
-import pandas as pd
+import numpy as np
+from sklearn.model_selection import train_test_split
 from sklearn.neural_network import MLPRegressor
 
 from common.base_script import BaseScript
+from common.extended_dataset import ExtendedDataset
 from common.log_stdout_through_logger import write_stdout_through_logger
+from rating_evaluator.mini_batch_stream import MiniBatchStream
+from rating_evaluator.trope_contributions import TropeContributions
 
 
 class EvaluatorBuilder(BaseScript):
     EVERYTHING_BUT_TROPES = ['Id', 'NameTvTropes', 'NameIMDB', 'Rating', 'Votes', 'Year']
+    VALIDATION_FRACTION = 0.1
+    TOLERANCE = 0.0001
 
-    def __init__(self, source_extended_dataset, random_seed=0):
+    def __init__(self, source_extended_dataset, random_seed=0, dense_inputs=False, previous_evaluator=None,
+                 max_epochs=200, epochs_without_improvement=10, streaming=False, batch_size=200, prefetch_batches=4):
         logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
                             datefmt='%m-%d %H:%M:%m', )
 
+        if max_epochs < 1:
+            raise ValueError(f'max_epochs must be at least 1: {max_epochs}')
+
         self.source_extended_dataset = source_extended_dataset
         self.random_seed = random_seed
+        self.dense_inputs = dense_inputs
+        self.previous_evaluator = previous_evaluator
+        self.max_epochs = max_epochs
+        self.epochs_without_improvement = epochs_without_improvement
+        self.streaming = streaming
+        self.batch_size = batch_size
+        self.prefetch_batches = prefetch_batches
 
-        parameters = dict(source_extended_dataset=source_extended_dataset, random_seed=random_seed)
+        parameters = dict(source_extended_dataset=source_extended_dataset, random_seed=random_seed,
+                          dense_inputs=dense_inputs, previous_evaluator=previous_evaluator, max_epochs=max_epochs,
+                          epochs_without_improvement=epochs_without_improvement, streaming=streaming,
+                          batch_size=batch_size, prefetch_batches=prefetch_batches)
         BaseScript.__init__(self, parameters)
 
         self.extended_dataframe = None
@@ -33,25 +51,178 @@ class EvaluatorBuilder(BaseScript):
         self.neural_network = None
 
     def run(self):
-        self._load_dataframe()
+        if self.streaming:
+            self._train_streaming()
+            return
 
-        self.trope_names = [key for key in self.extended_dataframe.keys() if key not in self.EVERYTHING_BUT_TROPES]
-        inputs = self.extended_dataframe.loc[:][self.trope_names].values
-        outputs = self.extended_dataframe.loc[:]['Rating'].values
-        tropes_count = len(self.trope_names)
+        if self.dense_inputs:
+            inputs, outputs = self._load_dense_inputs_and_outputs()
+        else:
+            inputs, outputs = self._load_sparse_inputs_and_outputs()
+
+        if self.previous_evaluator:
+            self._train_incrementally(inputs, outputs)
+            return
 
-        self._calculate_layer_sizes(tropes_count, number_of_layers=3)
+        self._calculate_layer_sizes(len(self.trope_names), number_of_layers=3)
+        self.neural_network = MLPRegressor(**self._build_network_parameters())
+
+        with write_stdout_through_logger(self._logger):
+            self.neural_network.fit(inputs, outputs)
+
+    def _build_network_parameters(self, **overridden_parameters):
         parameters = dict(activation='relu', alpha=0.0001, random_state=self.random_seed,
                           hidden_layer_sizes=tuple(self.layer_sizes[1:-1]),
                           solver='sgd', max_iter=1000, verbose=100, learning_rate='constant',
                           early_stopping=True)
+        parameters.update(overridden_parameters)
         for key,value in parameters.items():
             self._add_to_summary(key, value)
+        return parameters
 
-        self.neural_network = MLPRegressor(**parameters)
+    def _train_incrementally(self, inputs, outputs):
+        self._load_previous_neural_network()
 
-        with write_stdout_through_logger(self._logger):
-            self.neural_network.fit(inputs, outputs)
+        training_inputs, validation_inputs, training_outputs, validation_outputs = train_test_split(
+            inputs, outputs, test_size=self.VALIDATION_FRACTION, random_state=self.random_seed)
+
+        def train_epoch():
+            self.neural_network.partial_fit(training_inputs, training_outputs)
+
+        def get_validation_score():
+            return self.neural_network.score(validation_inputs, validation_outputs)
+
+        self._train_epochs(train_epoch, get_validation_score)
+
+    def _train_streaming(self):
+        dataset = ExtendedDataset.load(self.source_extended_dataset)
+        self.trope_names = dataset.trope_names.tolist()
+
+        film_indexes = np.random.RandomState(self.random_seed).permutation(len(dataset))
+        validation_size = int(len(film_indexes) * self.VALIDATION_FRACTION)
+        training_stream = MiniBatchStream(dataset, film_indexes[validation_size:], self.batch_size,
+                                          self.prefetch_batches, shuffle=True, random_seed=self.random_seed)
+        validation_stream = MiniBatchStream(dataset, film_indexes[:validation_size], self.batch_size,
+                                            self.prefetch_batches, shuffle=False)
+
+        if self.previous_evaluator:
+            self._load_previous_neural_network()
+        else:
+            self._calculate_layer_sizes(len(self.trope_names), number_of_layers=3)
+            parameters = self._build_network_parameters(batch_size=self.batch_size, early_stopping=False,
+                                                        verbose=False)
+            self.neural_network = MLPRegressor(**parameters)
+
+        def train_epoch():
+            for inputs, outputs in training_stream:
+                self.neural_network.partial_fit(inputs, outputs)
+
+        def get_validation_score():
+            return self._get_streamed_score(validation_stream)
+
+        self._train_epochs(train_epoch, get_validation_score)
+
+    def _get_streamed_score(self, stream):
+        # Coefficient of determination (R^2, as MLPRegressor.score) accumulated batch by batch. It is None without
+        # validation films, and constant ratings score as in sklearn's r2_score (1 if predicted exactly, 0 if not).
+        count = 0
+        outputs_sum = 0.0
+        outputs_squared_sum = 0.0
+        squared_errors_sum = 0.0
+        for inputs, outputs in stream:
+            predictions = self.neural_network.predict(inputs)
+            count += len(outputs)
+            outputs_sum += outputs.sum()
+            outputs_squared_sum += (outputs ** 2).sum()
+            squared_errors_sum += ((outputs - predictions) ** 2).sum()
+
+        if count == 0:
+            return None
+
+        total_sum_of_squares = outputs_squared_sum - outputs_sum ** 2 / count
+        if total_sum_of_squares <= 0:
+            return 1.0 if squared_errors_sum == 0 else 0.0
+        return 1 - squared_errors_sum / total_sum_of_squares
+
+    def _train_epochs(self, train_epoch, get_validation_score):
+        best_score = None
+        best_parameters = None
+        epochs_without_improvement = 0
+        for epoch in range(1, self.max_epochs + 1):
+            train_epoch()
+            score = get_validation_score()
+            self._info(f'Iteration {epoch}, loss = {self.neural_network.loss_:.8f}')
+            if score is None:
+                # Nothing to validate with, so the last epoch is kept and there is no early stopping
+                continue
+
+            self._info(f'Validation score: {score:.6f}')
+            if best_score is None or score > best_score + self.TOLERANCE:
+                best_score = score
+                best_parameters = ([weights.copy() for weights in self.neural_network.coefs_],
+                                   [intercepts.copy() for intercepts in self.neural_network.intercepts_])
+                epochs_without_improvement = 0
+            else:
+                epochs_without_improvement += 1
+                if epochs_without_improvement >= self.epochs_without_improvement:
+                    break
+
+        if best_parameters is not None:
+            self.neural_network.coefs_, self.neural_network.intercepts_ = best_parameters
+        self._add_to_summary('Epochs', epoch)
+        self._add_to_summary('Best validation score', best_score)
+
+    def _load_previous_neural_network(self):
+        previous_resources = joblib.load(self.previous_evaluator)
+        self.neural_network = previous_resources['evaluator']
+        self._extend_input_layer(previous_resources['inputs'])
+        self._prepare_network_for_partial_fit()
+
+        self.layer_sizes = [len(self.trope_names)] + [weights.shape[1] for weights in self.neural_network.coefs_]
+        self._add_to_summary('Layer sizes', self.layer_sizes)
+
+    def _extend_input_layer(self, previous_trope_names):
+        previous_positions = {trope: index for index, trope in enumerate(previous_trope_names)}
+        kept_positions = [(index, previous_positions[trope]) for index, trope in enumerate(self.trope_names)
+                          if trope in previous_positions]
+
+        previous_weights = self.neural_network.coefs_[0]
+        weights = np.zeros((len(self.trope_names), previous_weights.shape[1]), dtype=previous_weights.dtype)
+        if kept_positions:
+            new_positions, old_positions = zip(*kept_positions)
+            weights[list(new_positions)] = previous_weights[list(old_positions)]
+
+        self.neural_network.coefs_[0] = weights
+        self.neural_network.n_features_in_ = len(self.trope_names)
+
+        self._add_to_summary('Tropes kept from previous evaluator', len(kept_positions))
+        self._add_to_summary('Tropes added', len(self.trope_names) - len(kept_positions))
+        self._add_to_summary('Tropes removed', len(previous_trope_names) - len(kept_positions))
+
+    def _prepare_network_for_partial_fit(self):
+        # The validation split replaces sklearn's early stopping, which partial_fit does not support, and the
+        # optimizer state is rebuilt because its moments were shaped for the previous input layer.
+        self.neural_network.verbose = False
+        self.neural_network.early_stopping = False
+        if getattr(self.neural_network, 'best_loss_', None) is None:
+            self.neural_network.best_loss_ = np.inf
+        if hasattr(self.neural_network, '_optimizer'):
+            del self.neural_network._optimizer
+
+    def _load_dense_inputs_and_outputs(self):
+        self._load_dataframe()
+
+        self.trope_names = [key for key in self.extended_dataframe.keys() if key not in self.EVERYTHING_BUT_TROPES]
+        inputs = self.extended_dataframe.loc[:][self.trope_names].values
+        outputs = self.extended_dataframe.loc[:]['Rating'].values
+        return inputs, outputs
+
+    def _load_sparse_inputs_and_outputs(self):
+        dataset = ExtendedDataset.load(self.source_extended_dataset)
+
+        self.trope_names = dataset.trope_names.tolist()
+        self._add_to_summary('Films x tropes (non zero values)', f'{dataset.tropes.shape} ({dataset.tropes.nnz})')
+        return dataset.tropes, dataset.ratings
 
     def _calculate_layer_sizes(self, tropes_count, number_of_layers=3):
         # Number of hidden nodes: There is no magic formula for selecting the optimum number of hidden neurons.
@@ -71,15 +242,7 @@ class EvaluatorBuilder(BaseScript):
         self._add_to_summary('Layer sizes', self.layer_sizes)
 
     def _load_dataframe(self):
-        self.extended_dataframe = None
-        hdf_name = self.source_extended_dataset.replace('.csv.bz2', '.h5')
-        if os.path.isfile(hdf_name):
-            self.extended_dataframe = pd.read_hdf(hdf_name)
-        else:
-            with open(self.source_extended_dataset, 'rb') as file:
-                compressed_content = file.read()
-            csv_content = bz2.decompress(compressed_content)
-            self.extended_dataframe = pd.read_csv(StringIO(csv_content.decode('utf-8')))
+        self.extended_dataframe = ExtendedDataset.load(self.source_extended_dataset).to_dataframe()
 
     def pickle(self, target_folder):
         file_name = f'evaluator_{"_".join([str(value) for value in self.layer_sizes])}.sav'
@@ -89,5 +252,13 @@ class EvaluatorBuilder(BaseScript):
         joblib.dump(return_data, file_path, compress=False)
         self._add_to_summary('Pickled evaluator path', file_path)
 
+        self._write_trope_contributions(file_path)
+
+    def _write_trope_contributions(self, evaluator_file_path):
+        contributions = TropeContributions.build(self.neural_network, self.trope_names)
+        file_path = TropeContributions.get_file_path(evaluator_file_path)
+        contributions.write(file_path)
+        self._add_to_summary('Trope contributions path', file_path)
+
     def finish(self):
         self._finish_and_summary()
@@ -1,18 +1,19 @@
 from __future__ import print_function
 
-import bz2
+import json
 import logging
 import math
 import os
-from io import StringIO
 
 import joblib
-import pandas as pd
+from sklearn.experimental import enable_halving_search_cv  # required to import HalvingGridSearchCV
 from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import HalvingGridSearchCV
 from sklearn.model_selection import RepeatedKFold
 from sklearn.neural_network import MLPRegressor
 
 from common.base_script import BaseScript
+from common.extended_dataset import ExtendedDataset
 from common.log_stdout_through_logger import write_stdout_through_logger
 
 
@@ -21,50 +22,59 @@ from common.log_stdout_through_logger import write_stdout_through_logger
 
 class EvaluatorHyperparametersTester(BaseScript):
     EVERYTHING_BUT_TROPES = ['Id', 'NameTvTropes', 'NameIMDB', 'Rating', 'Votes', 'Year']
+    GRID_SEARCH = 'grid'
+    HALVING_SEARCH = 'halving'
+    RESULT_MESSAGE_PREFIX = 'Result: '
 
-    def __init__(self, source_extended_dataset):
+    def __init__(self, source_extended_dataset, search=HALVING_SEARCH, n_jobs=6, max_epochs=100, factor=3,
+                 random_seed=0):
         logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
                             datefmt='%m-%d %H:%M:%m', )
 
-        self.source_extended_dataset = source_extended_dataset
+        if search not in [self.GRID_SEARCH, self.HALVING_SEARCH]:
+            raise ValueError(f'Unknown search mode: {search}')
 
-        parameters = dict(source_extended_dataset=source_extended_dataset)
+        self.source_extended_dataset = source_extended_dataset
+        self.search = search
+        self.n_jobs = n_jobs
+        self.max_epochs = max_epochs
+        self.factor = factor
+        self.random_seed = random_seed
+
+        parameters = dict(source_extended_dataset=source_extended_dataset, search=search, n_jobs=n_jobs,
+                          max_epochs=max_epochs, factor=factor, random_seed=random_seed)
         BaseScript.__init__(self, parameters)
 
         self.parameter_space = {}
-        self.extended_dataframe = None
         self.trope_names = None
         self.layer_sizes = []
         self.clf = None
 
     def run(self):
-        self._load_dataframe()
+        inputs, outputs = self._load_inputs_and_outputs()
+        self._calculate_layer_sizes()
         self._build_parameter_space()
 
-        self.trope_names = [key for key in self.extended_dataframe.keys() if key not in self.EVERYTHING_BUT_TROPES]
-        inputs = self.extended_dataframe.loc[:][self.trope_names].values
-        outputs = self.extended_dataframe.loc[:]['Rating'].values
-
-        self._calculate_layer_sizes()
         mlp = MLPRegressor(verbose=100, early_stopping=True)
+        cv = RepeatedKFold(n_splits=3, n_repeats=1, random_state=self.random_seed)
+        if self.search == self.HALVING_SEARCH:
+            # Every round trains the surviving candidates for `factor` times more epochs, so hopeless
+            # configurations are discarded after a few epochs instead of running the whole budget.
+            self.clf = HalvingGridSearchCV(mlp, self.parameter_space, factor=self.factor, resource='max_iter',
+                                           max_resources=self.max_epochs, min_resources='exhaust',
+                                           n_jobs=self.n_jobs, cv=cv, random_state=self.random_seed)
+        else:
+            self.clf = GridSearchCV(mlp, self.parameter_space, n_jobs=self.n_jobs, cv=cv)
 
-        cv = RepeatedKFold(n_splits=3, n_repeats=1)
-        self.clf = GridSearchCV(mlp, self.parameter_space, n_jobs=6, cv=cv)  # n_jobs=-1
         with write_stdout_through_logger(self._logger):
             self.clf.fit(inputs, outputs)
 
-        self._log_grid_results()
+        self._log_search_results()
 
-    def _load_dataframe(self):
-        self.extended_dataframe = None
-        hdf_name = self.source_extended_dataset.replace('.csv.bz2', '.h5')
-        if os.path.isfile(hdf_name):
-            self.extended_dataframe = pd.read_hdf(hdf_name)
-        else:
-            with open(self.source_extended_dataset, 'rb') as file:
-                compressed_content = file.read()
-            csv_content = bz2.decompress(compressed_content)
-            self.extended_dataframe = pd.read_csv(StringIO(csv_content.decode('utf-8')))
+    def _load_inputs_and_outputs(self):
+        dataset = ExtendedDataset.load(self.source_extended_dataset)
+        self.trope_names = dataset.trope_names.tolist()
+        return dataset.tropes, dataset.ratings
 
     def _build_parameter_space(self):
         self.parameter_space = {
@@ -72,10 +82,12 @@ class EvaluatorHyperparametersTester(BaseScript):
             'activation': ['tanh', 'relu'],
             'solver': ['sgd', 'adam'],
             'alpha': [0.0001],
-            'max_iter': [100],
             'learning_rate': ['constant', 'adaptive'],
             'early_stopping': [False]
         }
+        if self.search == self.GRID_SEARCH:
+            self.parameter_space['max_iter'] = [self.max_epochs]
+
         for key, value in self.parameter_space.items():
             self._add_to_summary(key, value)
 
@@ -89,13 +101,20 @@ class EvaluatorHyperparametersTester(BaseScript):
 
         self._add_to_summary('Layer sizes', self.layer_sizes)
 
-    def _log_grid_results(self):
-        means = self.clf.cv_results_['mean_test_score']
-        stds = self.clf.cv_results_['std_test_score']
-        for mean, std, params in zip(means, stds, self.clf.cv_results_['params']):
-            params['mean'] = mean
-            params['std'] = std
-            self._info(f'Result: {mean} (+/-{std}) for {params}')
+    def _log_search_results(self):
+        results = self.clf.cv_results_
+        for index, params in enumerate(results['params']):
+            result = dict(params)
+            result['hidden_layer_sizes'] = list(result['hidden_layer_sizes'])
+            result['mean'] = float(results['mean_test_score'][index])
+            result['std'] = float(results['std_test_score'][index])
+            if 'n_resources' in results:
+                result['max_iter'] = int(results['n_resources'][index])
+                result['round'] = int(results['iter'][index])
+            self._info(f'{self.RESULT_MESSAGE_PREFIX}{json.dumps(result, sort_keys=True)}')
+
+        self._add_to_summary('Best parameters', dict(self.clf.best_params_))
+        self._add_to_summary('Best score', float(self.clf.best_score_))
 
     def pickle(self, target_folder):
         file_name = f'evaluator_hyperparameters.sav'
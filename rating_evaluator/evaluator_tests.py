@@ -10,6 +10,7 @@ import os
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from common.compressed_files import load_compressed_json
 from rating_evaluator.neural_network_tropes_evaluator import NeuralNetworkTropesEvaluator
 
 
@@ -21,18 +22,12 @@ class EvaluatorTests(object):
         self.test_results = {}
 
     def init_from_file(self, serialized_data_file):
-        with bz2.open(serialized_data_file, "rb") as f:
-            content = f.read()
-        json_bytes = content.decode('utf-8')
-        self.test_results = json.loads(json_bytes)
+        self.test_results = load_compressed_json(serialized_data_file)
 
     def run_tests(self):
         evaluator = NeuralNetworkTropesEvaluator(self.evaluator_file)
         print("Reading file")
-        with bz2.open(self.extended_dataset_file, "rb") as f:
-            content = f.read()
-        json_bytes = content.decode('utf-8')
-        films = json.loads(json_bytes)
+        films = load_compressed_json(self.extended_dataset_file)
         print("File read")
         for film in films:
             film['evaluation'] = evaluator.evaluate_just_rating(film['tropes'])[0]
@@ -62,7 +57,7 @@ class EvaluatorTests(object):
             self.test_results['errors_by_tropes_stats'].append(item)
 
         genres = [trope for trope in evaluator.tropes if '[GENRE]' in trope]
-        genres_evaluation = [{'Genre': genre, 'Estimated rating': evaluator.evaluate_just_rating(genre)[0]}
+        genres_evaluation = [{'Genre': genre, 'Estimated rating': evaluator.get_trope_contribution(genre).rating_alone}
                              for genre in genres]
         self.test_results['evaluations_1_genre'] = genres_evaluation
 
@@ -0,0 +1,85 @@
+from queue import Full, Queue
+from threading import Event, Thread
+
+import numpy as np
+from scipy import sparse
+
+
+class MiniBatchStream(object):
+    """
+    Iterates over mini-batches of (film tropes, ratings) read from a memory-mapped ExtendedDataset.
+
+    Batches are built in a background thread and at most `prefetch_batches` of them are kept in memory, so the memory
+    used while training depends on the batch size and not on the size of the dataset. If the consumer stops early, the
+    background thread is stopped too.
+    """
+    END_OF_STREAM = None
+    PUT_TIMEOUT = 0.1
+
+    def __init__(self, dataset, film_indexes, batch_size=200, prefetch_batches=4, shuffle=True, random_seed=0):
+        self.dataset = dataset
+        self.film_indexes = np.asarray(film_indexes)
+        self.batch_size = batch_size
+        self.prefetch_batches = prefetch_batches
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(random_seed)
+
+    def __iter__(self):
+        film_indexes = self.random.permutation(self.film_indexes) if self.shuffle else self.film_indexes
+        queue = Queue(maxsize=self.prefetch_batches)
+        stop = Event()
+        producer = Thread(target=self._produce_batches, args=(film_indexes, queue, stop), daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                batch = queue.get()
+                if batch is self.END_OF_STREAM:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+            while not queue.empty():
+                queue.get_nowait()
+
+    def __len__(self):
+        return (len(self.film_indexes) + self.batch_size - 1) // self.batch_size
+
+    def _produce_batches(self, film_indexes, queue, stop):
+        try:
+            for start in range(0, len(film_indexes), self.batch_size):
+                if not self._put(queue, self._build_batch(film_indexes[start:start + self.batch_size]), stop):
+                    return
+        except Exception as exception:
+            self._put(queue, exception, stop)
+        finally:
+            self._put(queue, self.END_OF_STREAM, stop)
+
+    def _put(self, queue, item, stop):
+        """
+        Waits for room in the queue until the consumer stops. Returns whether the item was queued
+        """
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=self.PUT_TIMEOUT)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _build_batch(self, film_indexes):
+        indptr = self.dataset.tropes.indptr
+        indices = self.dataset.tropes.indices
+        starts = indptr[film_indexes]
+        ends = indptr[film_indexes + 1]
+
+        batch_indices = np.concatenate([indices[start:end] for start, end in zip(starts, ends)])
+        batch_indptr = np.concatenate([[0], np.cumsum(ends - starts)])
+        batch_data = np.ones(len(batch_indices), dtype=np.float64)
+        inputs = sparse.csr_matrix((batch_data, batch_indices, batch_indptr),
+                                   shape=(len(film_indexes), len(self.dataset.trope_names)))
+        outputs = np.asarray(self.dataset.ratings[film_indexes])
+        return inputs, outputs
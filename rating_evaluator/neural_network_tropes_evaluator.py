@@ -1,9 +1,11 @@
 import logging
+import os
 
 import joblib
 
 from common.base_script import BaseScript
 from common.string_utils import humanize_list
+from rating_evaluator.trope_contributions import TropeContributions
 
 
 class NeuralNetworkTropesEvaluator(BaseScript):
@@ -23,6 +25,19 @@ class NeuralNetworkTropesEvaluator(BaseScript):
             self.tropes_reverse_index[trope] = index
 
         self.base_empty_input = [0 for index in range(0, len(self.tropes))]
+        self.contributions = self._load_trope_contributions(neural_network_dumped_file)
+
+    def _load_trope_contributions(self, neural_network_dumped_file):
+        file_path = TropeContributions.get_file_path(neural_network_dumped_file)
+        if os.path.isfile(file_path):
+            self._track_step('Loading trope contributions')
+            return TropeContributions.read(file_path)
+
+        self._track_step('Building trope contributions')
+        return TropeContributions.build(self.neural_network, self.tropes)
+
+    def get_trope_contribution(self, trope: str):
+        return self.contributions.get(trope)
 
     def evaluate(self, list_of_tropes: list):
         self._track_message(f'Evaluating {list_of_tropes}')
@@ -102,5 +117,5 @@ if __name__ == "__main__":
 
     print('Evaluation of 1 genre')
     genres = [trope for trope in evaluator.tropes if '[GENRE]' in trope]
-    genres_evaluation = {genre:evaluator.evaluate_just_rating(genre)[0] for genre in genres}
+    genres_evaluation = {genre:evaluator.get_trope_contribution(genre).rating_alone for genre in genres}
     print(json.dumps(genres_evaluation, sort_keys=True, indent=2))
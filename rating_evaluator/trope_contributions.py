@@ -0,0 +1,78 @@
+import csv
+import os
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from scipy import sparse
+
+TropeContribution = namedtuple('TropeContribution', 'trope rating_alone contribution first_layer_norm')
+
+
+class TropeContributions(object):
+    """
+    Table with the effect of every trope on the rating predicted by a trained evaluator:
+
+    - rating_alone: rating predicted for a film that only has the trope.
+    - contribution: difference between rating_alone and the rating predicted for a film without tropes.
+    - first_layer_norm: euclidean norm of the first layer weights of the trope.
+
+    It is stored as a CSV file next to the evaluator. Its first row, without trope, keeps the baseline rating.
+    """
+    HEADER = ['Trope', 'RatingAlone', 'Contribution', 'FirstLayerNorm']
+    FILE_SUFFIX = '_contributions.csv'
+    PREDICTION_BATCH_SIZE = 2048
+
+    def __init__(self, baseline_rating, contributions):
+        self.baseline_rating = baseline_rating
+        self.contributions = contributions
+
+    @classmethod
+    def build(cls, neural_network, trope_names):
+        number_of_tropes = len(trope_names)
+        baseline_rating = float(neural_network.predict(sparse.csr_matrix((1, number_of_tropes)))[0])
+
+        ratings_alone = []
+        single_trope_inputs = sparse.identity(number_of_tropes, format='csr')
+        for start in range(0, number_of_tropes, cls.PREDICTION_BATCH_SIZE):
+            ratings_alone.extend(neural_network.predict(single_trope_inputs[start:start + cls.PREDICTION_BATCH_SIZE]))
+        first_layer_norms = np.linalg.norm(neural_network.coefs_[0], axis=1)
+
+        contributions = OrderedDict()
+        for trope, rating_alone, first_layer_norm in zip(trope_names, ratings_alone, first_layer_norms):
+            contributions[trope] = TropeContribution(trope, float(rating_alone), float(rating_alone) - baseline_rating,
+                                                     float(first_layer_norm))
+        return cls(baseline_rating, contributions)
+
+    @classmethod
+    def get_file_path(cls, evaluator_file):
+        return f'{os.path.splitext(evaluator_file)[0]}{cls.FILE_SUFFIX}'
+
+    @classmethod
+    def read(cls, file_path):
+        contributions = OrderedDict()
+        with open(file_path, 'r', newline='') as file:
+            reader = csv.reader(file)
+            next(reader)
+            baseline_rating = float(next(reader)[1])
+            for trope, rating_alone, contribution, first_layer_norm in reader:
+                contributions[trope] = TropeContribution(trope, float(rating_alone), float(contribution),
+                                                         float(first_layer_norm))
+        return cls(baseline_rating, contributions)
+
+    def write(self, file_path):
+        with open(file_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(self.HEADER)
+            writer.writerow(['', self.baseline_rating, 0.0, 0.0])
+            for contribution in self.contributions.values():
+                writer.writerow(contribution)
+
+    def get(self, trope):
+        return self.contributions.get(trope, None)
+
+    def sorted_by_contribution(self, reverse=True):
+        return sorted(self.contributions.values(), key=lambda contribution: contribution.contribution,
+                      reverse=reverse)
+
+    def __len__(self):
+        return len(self.contributions)
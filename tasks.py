@@ -4,6 +4,8 @@ from multiprocessing import Pool
 
 from invoke import task, run
 
+from dataset_displayers.dataset_to_sqlite import DatabaseBuilder
+from dataset_displayers.displayer import Displayer
 from mapper.film_mapper import FilmMapper
 from rating_evaluator.evaluator_builder import EvaluatorBuilder
 from rating_evaluator.evaluator_hyperparameters_tester import EvaluatorHyperparametersTester
@@ -12,46 +14,120 @@ from tvtropes_scraper.tvtropes_scraper import TVTropesScraper
 
 
 @task
-def scrape_tvtropes(context, cache_directory=None, session=None):
+def scrape_tvtropes(context, cache_directory=None, session=None,
+                    requests_per_second=TVTropesScraper.REQUESTS_PER_SECOND,
+                    concurrent_requests=TVTropesScraper.CONCURRENT_REQUESTS, previous_session=None, workers=None,
+                    namespaces=','.join(TVTropesScraper.NAMESPACES)):
     """
-    Scrape tropes by film in TvTropes.org
+    Scrape tropes by film (or by work of other namespaces) in TvTropes.org
 
     :param cache_directory: The folder that all the downloaded pages are going to be written into.
     :param session: (Optional) Name of the cache folder. If not provided, then it will use the current date/time.
+    :param requests_per_second: Maximum number of requests started per second to TvTropes.org.
+    :param concurrent_requests: Maximum number of requests in flight at the same time.
+    :param previous_session: (Optional) Name of a previous cache folder. Its pages are requested conditionally (with
+    their ETag/Last-Modified) and reused when they did not change, and the pages that are new, changed or unchanged
+    are counted in the summary.
+    :param workers: Number of processes extracting links from the pages (all the CPUs by default, 1 to extract them in
+    this process).
+    :param namespaces: Comma-separated TVTropes namespaces to crawl in the same pass (e.g. Film,Series,Literature).
+    The tropes of every namespace are saved into '<lowercase namespace>_tropes_<session>.json.bz2' (e.g.
+    'series_tropes_...' for Series), or 'films_tropes_<session>.json.bz2' for Film.
     """
     if cache_directory is None:
         print('Please, add the missing parameters!!')
 
     TVTropesScraper.set_logger_file_id('scrape_tvtropes', session)
-    scraper = TVTropesScraper(directory=cache_directory, session=session)
+    scraper = TVTropesScraper(directory=cache_directory, session=session,
+                              requests_per_second=float(requests_per_second),
+                              concurrent_requests=int(concurrent_requests), previous_session=previous_session,
+                              workers=int(workers) if workers else None, namespaces=namespaces.split(','))
     scraper.run()
 
 
 @task
 def map_films(context, tvtropes_films_file, imdb_titles_file, imdb_ratings_file,
-              target_dataset='datasets/extended_dataset.csv', remove_ambiguities=False):
+              target_dataset='datasets/extended_dataset.csv', remove_ambiguities=False, export_csv=False,
+              workers=None, imdb_index_file=None, fuzzy_matching=False, previous_mapping=None):
     """
     Map scraped films from TvTropes.org to IMDB.com
 
     :type tvtropes_films_file: path to the scraped file 'film_tropes_<datetime>.json.bz2'.
-    :type imdb_titles_file: path to the file 'title.basics.tsv'
-    :type imdb_ratings_file: path to the file 'title.ratings.tsv'
+    :type imdb_titles_file: path to the file 'title.basics.tsv' (or 'title.basics.tsv.gz' as downloaded from IMDb)
+    :type imdb_ratings_file: path to the file 'title.ratings.tsv' (or 'title.ratings.tsv.gz')
     :type target_dataset: path to the target file (csv)
     :type remove_ambiguities: Remove ambiguity by selecting the most popular film when different films from IMDb match
     the film in TVTropes
+    :type export_csv: Also write the dense films x tropes CSV (<target_dataset>.csv.bz2) next to the sparse dataset
+    (<target_dataset>.sparse), which is always written
+    :type workers: number of processes parsing IMDb titles (all the CPUs by default, 1 to parse them in this process)
+    :type imdb_index_file: (Optional) path to an IMDb index (see build_imdb_index). It is used instead of parsing the
+    IMDb files when it was built from them, and rebuilt otherwise
+    :type fuzzy_matching: Look for IMDb films with a similar name (and the same year, when known) for the films that
+    are not found by their exact name
+    :type previous_mapping: (Optional) path to the '<target_dataset>.mapping.json.bz2' file of a previous execution.
+    The films in it keep their IMDb matches, so only the new films are looked up in IMDb
     """
 
     _check_file_exists('tvtropes_films_file', tvtropes_films_file)
     _check_file_exists('imdb_titles_file', imdb_titles_file)
     _check_file_exists('imdb_ratings_file', imdb_ratings_file)
+    if previous_mapping is not None:
+        _check_file_exists('previous_mapping', previous_mapping)
 
     FilmMapper.set_logger_file_id('map_films')
     mapper = FilmMapper(tvtropes_films_file=tvtropes_films_file, imdb_titles_file=imdb_titles_file,
                         imdb_ratings_file=imdb_ratings_file, target_dataset=target_dataset,
-                        remove_ambiguities=remove_ambiguities)
+                        remove_ambiguities=remove_ambiguities, export_csv=export_csv,
+                        workers=int(workers) if workers else None, imdb_index_file=imdb_index_file,
+                        fuzzy_matching=fuzzy_matching, previous_mapping_file=previous_mapping)
     mapper.run()
 
 
+@task
+def build_imdb_index(context, imdb_titles_file, imdb_ratings_file, imdb_index_file='datasets/imdb_index.sqlite',
+                     workers=None):
+    """
+    Build the index of IMDb titles by normalized name used by map_films, so the IMDb files are only parsed once
+
+    :type imdb_titles_file: path to the file 'title.basics.tsv' (or 'title.basics.tsv.gz' as downloaded from IMDb)
+    :type imdb_ratings_file: path to the file 'title.ratings.tsv' (or 'title.ratings.tsv.gz')
+    :type imdb_index_file: path to the target index (SQLite). It is not rebuilt if the IMDb files did not change
+    :type workers: number of processes parsing IMDb titles (all the CPUs by default, 1 to parse them in this process)
+    """
+    _check_file_exists('imdb_titles_file', imdb_titles_file)
+    _check_file_exists('imdb_ratings_file', imdb_ratings_file)
+
+    FilmMapper.set_logger_file_id('build_imdb_index')
+    mapper = FilmMapper(tvtropes_films_file=None, imdb_titles_file=imdb_titles_file,
+                        imdb_ratings_file=imdb_ratings_file, target_dataset=None, remove_ambiguities=False,
+                        workers=int(workers) if workers else None, imdb_index_file=imdb_index_file)
+    mapper.build_imdb_index()
+
+
+@task
+def build_films_database(context, extended_dataset, database_file='datasets/films_and_tropes.db', append=False):
+    """
+    Build the SQLite database with films, tropes and tropes by film used by show_genres, show_tropes and show_films
+
+    :type extended_dataset: path to the extended dataset CSV file written by map_films (.csv or .csv.bz2)
+    :type database_file: path to the target database (SQLite). It is rebuilt from scratch unless append is set
+    :type append: add the films of extended_dataset missing in an existing database_file, refreshing only the
+                  summaries they change
+    """
+    _check_file_exists('extended_dataset', extended_dataset)
+    if append:
+        _check_file_exists('database_file', database_file)
+
+    DatabaseBuilder.set_logger_file_id('build_films_database')
+    builder = DatabaseBuilder(database_file, extended_dataset)
+    if append:
+        builder.append_to_database()
+    else:
+        builder.build_database()
+    builder.display_statistics()
+
+
 def _check_file_exists(parameter, file_name):
     if not os.path.isfile(file_name):
         print(f'Please, provide a valid path for {parameter}')
@@ -59,7 +135,8 @@ def _check_file_exists(parameter, file_name):
 
 
 @task
-def build_evaluator(context, extended_dataset, target_folder='datasets/', random_seed=0):
+def build_evaluator(context, extended_dataset, target_folder='datasets/', random_seed=0, dense_inputs=False,
+                    previous_evaluator=None, max_epochs=200, streaming=False, batch_size=200):
     """
     Builds an evaluator using a Neural Network trained with the extended dataset.
     The inputs of the evaluator are the tropes of the film and the output is the rating.
@@ -67,47 +144,85 @@ def build_evaluator(context, extended_dataset, target_folder='datasets/', random
     :type extended_dataset: path of the csv/h5 file that contains the extended information from the films
     :type target_file: file that will keep the pickled evaluator, so it can be loaded and used later on
     :type random_seed: a number to use as random seed (executions with the same seed give the same results)
+    :type dense_inputs: train with the whole films x tropes matrix in memory instead of a sparse matrix
+    :type previous_evaluator: (Optional) pickled evaluator to continue training from instead of starting from scratch
+    :type max_epochs: maximum number of epochs when training from a previous evaluator or streaming
+    :type streaming: train with mini-batches read from the cached dataset in the background instead of in memory
+    :type batch_size: number of films of every mini-batch when streaming
 
     """
     FilmMapper.set_logger_file_id('build_evaluator')
 
-    evaluator = EvaluatorBuilder(extended_dataset, random_seed=int(random_seed))
+    evaluator = EvaluatorBuilder(extended_dataset, random_seed=int(random_seed), dense_inputs=dense_inputs,
+                                 previous_evaluator=previous_evaluator, max_epochs=int(max_epochs),
+                                 streaming=streaming, batch_size=int(batch_size))
     evaluator.run()
     evaluator.pickle(target_folder)
     evaluator.finish()
 
 
 @task
-def test_evaluator_hyperparameters(context, extended_dataset, target_folder='datasets/'):
+def test_evaluator_hyperparameters(context, extended_dataset, target_folder='datasets/', search='halving', n_jobs=6,
+                                   max_epochs=100):
     """
     Builds an evaluator using a Neural Network trained with the extended dataset.
     The inputs of the evaluator are the tropes of the film and the output is the rating.
 
     :type extended_dataset: path of the csv/h5 file that contains the extended information from the films
     :type target_file: file that will keep the pickled evaluator, so it can be loaded and used later on
-    :type random_seed: a number to use as random seed (executions with the same seed give the same results)
+    :type search: 'halving' (successive halving over epochs) or 'grid' (every combination with max_epochs)
+    :type n_jobs: number of parallel jobs (-1 uses all the processors)
+    :type max_epochs: maximum number of epochs that a combination of hyperparameters is trained for
 
     """
     FilmMapper.set_logger_file_id('build_evaluator_hyperparameters')
 
-    tester = EvaluatorHyperparametersTester(extended_dataset)
+    tester = EvaluatorHyperparametersTester(extended_dataset, search=search, n_jobs=int(n_jobs),
+                                            max_epochs=int(max_epochs))
     tester.run()
     # tester.pickle(target_folder)
     tester.finish()
 
 @task
-def show_genres(search_query, page=0, results=10):
-    print('TODO!')
+def show_genres(context, search_query='', page=0, results=10, database_file='datasets/films_and_tropes.db'):
+    """
+    Search genres by name in the films and tropes database
+
+    :type search_query: words the genre names start by (all the genres if empty)
+    :type page: page of results to show, starting by 0
+    :type results: number of results by page
+    :type database_file: path to the database built by build_films_database
+    """
+    _check_file_exists('database_file', database_file)
+    Displayer(database_file).search_genres(search_query, int(page), int(results))
 
 
 @task
-def show_tropes(search_query, page=1, results=10):
-    print('TODO!')
+def show_tropes(context, search_query='', page=0, results=10, database_file='datasets/films_and_tropes.db'):
+    """
+    Search tropes by name in the films and tropes database, with the number of films and average rating of each trope
+
+    :type search_query: words the trope names start by (e.g. 'distillation' finds AdaptationDistillation)
+    :type page: page of results to show, starting by 0
+    :type results: number of results by page
+    :type database_file: path to the database built by build_films_database
+    """
+    _check_file_exists('database_file', database_file)
+    Displayer(database_file).search_tropes(search_query, int(page), int(results))
 
 
 @task
-def show_films(search_query, page=2, results=10):
-    print('TODO!')
+def show_films(context, search_query='', page=0, results=10, database_file='datasets/films_and_tropes.db'):
+    """
+    Search films by their TVTropes or IMDb name in the films and tropes database, with their rating and tropes
+
+    :type search_query: words the film names start by (e.g. 'alone in the dark' or 'pulpfiction')
+    :type page: page of results to show, starting by 0
+    :type results: number of results by page
+    :type database_file: path to the database built by build_films_database
+    """
+    _check_file_exists('database_file', database_file)
+    Displayer(database_file).search_movies(search_query, int(page), int(results))
 
 
 @task
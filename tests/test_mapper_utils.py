@@ -0,0 +1,37 @@
+import json
+import os
+import unittest
+
+from mapper.film_mapper import MapperUtils
+
+GOLDEN_NORMALIZED_NAMES_FILE = os.path.join(os.path.dirname(__file__), 'fixtures', 'normalize_name_golden.json')
+
+
+class MapperUtilsTest(unittest.TestCase):
+    """
+    The golden file keeps the names normalized by the original (regex by regex) implementation of normalize_name,
+    which every optimization has to reproduce exactly
+    """
+
+    def setUp(self):
+        with open(GOLDEN_NORMALIZED_NAMES_FILE, encoding='utf-8') as golden_file:
+            self.golden_names = json.load(golden_file)
+        MapperUtils.NORMALIZED_NAMES.clear()
+
+    def test_normalize_name(self):
+        for name, normalized_name in self.golden_names.items():
+            self.assertEqual(normalized_name, MapperUtils.normalize_name(name), name)
+
+    def test_normalize_name_memoized(self):
+        for name in self.golden_names:
+            MapperUtils.normalize_name(name)
+        for name, normalized_name in self.golden_names.items():
+            self.assertEqual(normalized_name, MapperUtils.normalize_name(name), name)
+
+    def test_normalize_names(self):
+        names = list(self.golden_names)
+        self.assertEqual([self.golden_names[name] for name in names], MapperUtils.normalize_names(names))
+
+
+if __name__ == '__main__':
+    unittest.main()
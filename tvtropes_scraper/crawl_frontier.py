@@ -0,0 +1,33 @@
+from collections import OrderedDict
+
+
+class CrawlFrontier(object):
+    """
+    Pages waiting to be crawled, grouped by the kind of page (e.g. index, category or work pages).
+
+    A page is only added once to every kind, whatever the number of pages or namespaces linking to it, so the pages
+    shared by the namespaces being crawled (like the categories) are downloaded and parsed once.
+    """
+
+    def __init__(self):
+        self.seen_urls = {}
+        self.pending_pages = {}
+
+    def add(self, kind, url, data=None):
+        seen_urls = self.seen_urls.setdefault(kind, set())
+        if url in seen_urls:
+            return False
+
+        seen_urls.add(url)
+        self.pending_pages.setdefault(kind, OrderedDict())[url] = data
+        return True
+
+    def pop(self, kind):
+        """
+        Returns an OrderedDict with the pending pages of a kind, as {url: data} in the order they were added, and
+        removes them from the frontier
+        """
+        return self.pending_pages.pop(kind, OrderedDict())
+
+    def __len__(self):
+        return sum(len(pages) for pages in self.pending_pages.values())
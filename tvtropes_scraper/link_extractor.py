@@ -0,0 +1,28 @@
+from functools import lru_cache
+
+from lxml import etree
+
+
+@lru_cache(maxsize=None)
+def get_selector(xpath):
+    """
+    Compiles an XPath selector once per process
+    """
+    return etree.XPath(xpath, smart_strings=False)
+
+
+def extract_links(page, selector, link_types):
+    """
+    Returns {link_type: links} with the last part of the links matched by the XPath `selector` in an HTML page that
+    point to every `link_type` resource (e.g. '/Main/'), leaving out action links. It is a module function so it can
+    be run in a pool of processes.
+    """
+    links_by_type = {link_type: [] for link_type in link_types}
+    tree = etree.fromstring(page, etree.HTMLParser()) if page else None
+    if tree is None:
+        return links_by_type
+
+    links = [link for link in get_selector(selector)(tree) if link and 'action' not in link]
+    for link_type, type_links in links_by_type.items():
+        type_links.extend(link.split('/')[-1] for link in links if link_type in link)
+    return links_by_type
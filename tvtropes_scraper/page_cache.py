@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from urllib.request import pathname2url
+
+CachedPage = namedtuple('CachedPage', 'url content fetched_at etag last_modified', defaults=(None, None, None))
+
+
+class PageCache(object):
+    """
+    Pages downloaded by the scraper, packed in a single SQLite file.
+
+    Pages are keyed by the SHA-1 of their URL and their bodies are compressed with zlib, which is much faster to
+    decompress than bz2, so re-running a cached scrape is bounded by parsing instead of by opening thousands of files.
+    The whole cache of a session can be copied as one file.
+
+    Every page keeps the ETag and Last-Modified headers sent with it and the SHA-1 of its content, to issue conditional
+    requests in later sessions, and the links extracted from it, which are valid as long as its content is the same.
+    The cache is written in WAL mode while its session runs and switched back to a rollback journal when it is closed,
+    so the cache of a finished session can be opened read-only by a later one without writing into its directory.
+    """
+    FORMAT_VERSION = 2
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, file_path, read_only=False):
+        self.file_path = file_path
+        self.read_only = read_only
+        if read_only:
+            self._open_read_only()
+            return
+
+        self.connection = sqlite3.connect(file_path)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        format_version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS page (url_hash TEXT PRIMARY KEY, url TEXT NOT NULL, '
+                                    'content BLOB NOT NULL, size INTEGER NOT NULL, fetched_at TEXT NOT NULL)')
+            if format_version < 2:
+                for column in ['content_hash', 'etag', 'last_modified']:
+                    self.connection.execute(f'ALTER TABLE page ADD COLUMN {column} TEXT')
+                self.connection.execute('CREATE TABLE page_links (url_hash TEXT NOT NULL, extraction TEXT NOT NULL, '
+                                        'links TEXT NOT NULL, PRIMARY KEY (url_hash, extraction)) WITHOUT ROWID')
+            self.connection.execute(f'PRAGMA user_version = {self.FORMAT_VERSION}')
+
+    def _open_read_only(self):
+        if not os.path.isfile(self.file_path):
+            raise FileNotFoundError(f'Page cache not found: {self.file_path}')
+
+        self.connection = sqlite3.connect(f'file:{pathname2url(os.path.abspath(self.file_path))}?mode=ro', uri=True)
+        format_version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if format_version != self.FORMAT_VERSION:
+            self.connection.close()
+            raise ValueError(f'{self.file_path} was written by an older version of the scraper (format '
+                             f'{format_version}). Please, resume its session once to upgrade it')
+
+    @staticmethod
+    def get_url_hash(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_content_hash(content):
+        return hashlib.sha1(content).hexdigest()
+
+    def get(self, url):
+        row = self.connection.execute('SELECT content FROM page WHERE url_hash = ?',
+                                      (self.get_url_hash(url),)).fetchone()
+        return zlib.decompress(row[0]) if row is not None else None
+
+    def get_validators(self, url):
+        """
+        Returns (etag, last_modified, content_hash) of a cached page, or None when it is not cached
+        """
+        return self.connection.execute('SELECT etag, last_modified, content_hash FROM page WHERE url_hash = ?',
+                                       (self.get_url_hash(url),)).fetchone()
+
+    def put(self, url, content, fetched_at=None, etag=None, last_modified=None):
+        self.put_many([CachedPage(url, content, fetched_at, etag, last_modified)])
+
+    def put_many(self, pages):
+        pages = [CachedPage(*page) for page in pages]
+        url_hashes = [(self.get_url_hash(page.url),) for page in pages]
+        with self.connection:
+            self.connection.executemany('DELETE FROM page_links WHERE url_hash = ?', url_hashes)
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO page (url_hash, url, content, size, fetched_at, content_hash, etag, '
+                'last_modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((url_hash, page.url, zlib.compress(page.content, self.COMPRESS_LEVEL), len(page.content),
+                  (page.fetched_at or datetime.now()).isoformat(), self.get_content_hash(page.content), page.etag,
+                  page.last_modified) for (url_hash,), page in zip(url_hashes, pages)))
+
+    def copy_page(self, source_cache, url, etag=None, last_modified=None):
+        """
+        Copies a page, still compressed, and its extracted links from another cache. The page is marked as fetched
+        now, and its validators are updated with the ones given, if any.
+        """
+        url_hash = self.get_url_hash(url)
+        row = source_cache.connection.execute(
+            'SELECT url, content, size, content_hash, etag, last_modified FROM page WHERE url_hash = ?',
+            (url_hash,)).fetchone()
+        links = source_cache.connection.execute('SELECT url_hash, extraction, links FROM page_links '
+                                                'WHERE url_hash = ?', (url_hash,)).fetchall()
+        url, content, size, content_hash, previous_etag, previous_last_modified = row
+        with self.connection:
+            self.connection.execute('DELETE FROM page_links WHERE url_hash = ?', (url_hash,))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO page (url_hash, url, content, size, fetched_at, content_hash, etag, '
+                'last_modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (url_hash, url, content, size, datetime.now().isoformat(), content_hash, etag or previous_etag,
+                 last_modified or previous_last_modified))
+            self.connection.executemany('INSERT INTO page_links (url_hash, extraction, links) VALUES (?, ?, ?)',
+                                        links)
+
+    def get_links(self, url, extraction):
+        row = self.connection.execute('SELECT links FROM page_links WHERE url_hash = ? AND extraction = ?',
+                                      (self.get_url_hash(url), extraction)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_links(self, url, extraction, links):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO page_links (url_hash, extraction, links) VALUES (?, ?, ?)',
+                                    (self.get_url_hash(url), extraction, json.dumps(links)))
+
+    def __contains__(self, url):
+        return self.connection.execute('SELECT 1 FROM page WHERE url_hash = ?',
+                                       (self.get_url_hash(url),)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT count(*) FROM page').fetchone()[0]
+
+    def close(self):
+        if not self.read_only:
+            self.connection.execute('PRAGMA journal_mode = DELETE')
+        self.connection.close()
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import requests
+from requests.adapters import HTTPAdapter
+
+FetchedPage = namedtuple('FetchedPage', 'content etag last_modified modified')
+
+
+class TokenBucket(object):
+    """
+    Thread-safe limiter that lets `rate` acquisitions per second through on average, with bursts of `capacity`.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class PageFetcher(object):
+    """
+    Downloads pages through a pooled requests.Session, with a few requests in flight to hide the latency of the
+    server but never more than `requests_per_second` requests started per second, whatever the number of threads.
+
+    Responses with status 429 or 5xx and connection errors are retried with exponential backoff (or the time asked
+    by the Retry-After header). Other responses are returned as they are, as the scraper caches any page it gets.
+
+    Given the ETag or Last-Modified of a previous download, the request is conditional and a page that has not changed
+    is returned without content and with `modified` set to False.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, requests_per_second=2, concurrent_requests=4, max_retries=5, backoff_in_seconds=1,
+                 timeout_in_seconds=30):
+        self.concurrent_requests = concurrent_requests
+        self.max_retries = max_retries
+        self.backoff_in_seconds = backoff_in_seconds
+        self.timeout_in_seconds = timeout_in_seconds
+        self.token_bucket = TokenBucket(requests_per_second)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrent_requests, pool_maxsize=concurrent_requests)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, url, etag=None, last_modified=None):
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        for attempt in range(self.max_retries + 1):
+            self.token_bucket.acquire()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout_in_seconds)
+            except (requests.ConnectionError, requests.Timeout) as exception:
+                if attempt == self.max_retries:
+                    raise
+                self._wait_before_retry(url, attempt, str(exception))
+                continue
+
+            if response.status_code == requests.codes.not_modified:
+                return FetchedPage(None, response.headers.get('ETag', etag),
+                                   response.headers.get('Last-Modified', last_modified), False)
+            if response.status_code not in self.RETRY_STATUSES:
+                return FetchedPage(response.content, response.headers.get('ETag'),
+                                   response.headers.get('Last-Modified'), True)
+            if attempt == self.max_retries:
+                response.raise_for_status()
+            self._wait_before_retry(url, attempt, f'HTTP {response.status_code}',
+                                    response.headers.get('Retry-After'))
+
+    def _wait_before_retry(self, url, attempt, reason, retry_after=None):
+        wait_time = self.backoff_in_seconds * 2 ** attempt
+        if retry_after is not None and retry_after.isdigit():
+            wait_time = max(wait_time, int(retry_after))
+        self._logger.warning(f'{reason} retrieving {url}. Retrying in {wait_time} seconds')
+        time.sleep(wait_time)
+
+    def fetch_all(self, urls, validators=None):
+        """
+        Yields (url, FetchedPage or exception) in the order of `urls`, with at most `concurrent_requests` pages being
+        downloaded or waiting to be consumed. `validators` maps URLs to the (etag, last_modified) of their previous
+        download, if any.
+        """
+        urls = iter(urls)
+        validators = validators or {}
+        pending_pages = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrent_requests) as executor:
+            while True:
+                for url in islice(urls, self.concurrent_requests - len(pending_pages)):
+                    pending_pages.append((url, executor.submit(self.fetch, url, *validators.get(url, ()))))
+                if not pending_pages:
+                    return
+
+                url, future = pending_pages.popleft()
+                try:
+                    yield url, future.result()
+                except Exception as exception:
+                    yield url, exception
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,60 @@
+import json
+import os
+
+
+class ScrapingJournal(object):
+    """
+    Append-only file with the tropes of every film scraped in a session, one JSON line per film.
+
+    Every line is flushed when it is written, so the films already scraped survive a crash and are replayed when the
+    journal is opened again. Only the offset of every film is kept in memory, so the tropes are read back from the
+    journal when the result is written. A last line left incomplete by a crash is truncated.
+    """
+    ENCODING = 'utf-8'
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.offsets = {}
+        self._replay()
+        self.file = open(file_path, 'ab')
+        self.reader = open(file_path, 'rb')
+
+    def _replay(self):
+        if not os.path.isfile(self.file_path):
+            return
+
+        valid_size = 0
+        with open(self.file_path, 'rb') as file:
+            for line in file:
+                try:
+                    film, _ = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                self.offsets[film] = valid_size
+                valid_size += len(line)
+
+        if valid_size != os.path.getsize(self.file_path):
+            with open(self.file_path, 'r+b') as file:
+                file.truncate(valid_size)
+
+    def append(self, film, tropes):
+        offset = self.file.tell()
+        self.file.write(json.dumps([film, tropes]).encode(self.ENCODING) + b'\n')
+        self.file.flush()
+        self.offsets[film] = offset
+
+    def get(self, film):
+        self.reader.seek(self.offsets[film])
+        return json.loads(self.reader.readline())[1]
+
+    def __contains__(self, film):
+        return film in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.file.close()
+        self.reader.close()
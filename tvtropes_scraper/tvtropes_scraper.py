@@ -3,47 +3,77 @@ import bz2
 import datetime
 import json
 import os
-from collections import OrderedDict
-from time import sleep
-
-import requests
-from lxml import html
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 from common.base_script import BaseScript
+from common.compressed_files import open_bz2_writer
+from tvtropes_scraper.crawl_frontier import CrawlFrontier
+from tvtropes_scraper.link_extractor import extract_links
+from tvtropes_scraper.page_cache import PageCache
+from tvtropes_scraper.page_fetcher import PageFetcher
+from tvtropes_scraper.scraping_journal import ScrapingJournal
 
 
 class TVTropesScraper(BaseScript):
-    MAIN_SEARCH = 'https://tvtropes.org/pmwiki/pmwiki.php/Main/Film'
-    BASE_FILM_URL = 'https://tvtropes.org/pmwiki/pmwiki.php/Film/'
-    BASE_MAIN_URL = 'https://tvtropes.org/pmwiki/pmwiki.php/Main/'
-    TARGET_RESULT_FILE_TEMPLATE = 'films_tropes_{}.json'
+    """
+    Crawls the works of one or more TVTropes namespaces (Film, Series, Literature, VideoGame...) and the tropes
+    linked from their pages.
+
+    The index page of every namespace (Main/<namespace>) links to categories, which link to the works. Categories are
+    shared by all the namespaces, so they are crawled once and the works of every namespace are taken from them. The
+    cache, the rate limit and the process pool are shared too, and the tropes of every namespace are written to their
+    own file.
+    """
+    BASE_URL = 'https://tvtropes.org/pmwiki/pmwiki.php/'
+    BASE_MAIN_URL = BASE_URL + 'Main/'
+    NAMESPACES = ('Film',)
+    RESULT_NAME_BY_NAMESPACE = {'Film': 'films'}
+    TARGET_RESULT_FILE_TEMPLATE = '{}_tropes_{}.json'
+    JOURNAL_FILE_TEMPLATE = '{}_tropes_{}.journal.jsonl'
 
     WAIT_TIME_BETWEEN_CALLS_IN_SECONDS = 0.5
+    REQUESTS_PER_SECOND = 1 / WAIT_TIME_BETWEEN_CALLS_IN_SECONDS
+    CONCURRENT_REQUESTS = 4
     SESSION_DATETIME_FORMAT = '%Y%m%d_%H%M%S'
 
     MAIN_RESOURCE = '/Main/'
-    FILM_RESOURCE = '/Film/'
-    LINK_SELECTOR = 'a'
-    LINK_SELECTOR_INSIDE_ARTICLE = '#main-article ul li a'
-    LINK_ADDRESS_SELECTOR = 'href'
+    INDEX_PAGE = 'index'
+    CATEGORY_PAGE = 'category'
+    WORK_PAGE = 'work'
+    LINK_SELECTOR = '//a/@href'
+    LINK_SELECTOR_INSIDE_ARTICLE = "//*[@id='main-article']//ul//li//a/@href"
+    PAGES_WAITING_PER_WORKER = 4
     EXTENSION = '.html'
     COMPRESSED_EXTENSION = '.bz2'
     DEFAULT_ENCODING = 'utf-8'
-
-    def __init__(self, directory, session):
-        parameters = dict(directory=directory, session=session,
-                          wait_time_between_calls_in_seconds=self.WAIT_TIME_BETWEEN_CALLS_IN_SECONDS)
+    PAGE_CACHE_FILE_NAME = 'pages.sqlite'
+    LEGACY_IMPORT_BATCH_SIZE = 500
+
+    def __init__(self, directory, session, requests_per_second=REQUESTS_PER_SECOND,
+                 concurrent_requests=CONCURRENT_REQUESTS, previous_session=None, workers=None, namespaces=NAMESPACES):
+        namespaces = list(OrderedDict.fromkeys(namespace.strip() for namespace in namespaces if namespace.strip()))
+        parameters = dict(directory=directory, session=session, requests_per_second=requests_per_second,
+                          concurrent_requests=concurrent_requests, previous_session=previous_session, workers=workers,
+                          namespaces=namespaces)
         BaseScript.__init__(self, parameters)
 
         self.directory_name = directory
         self.session = session
+        self.workers = workers or os.cpu_count() or 1
+        self.namespaces = namespaces
         self._set_default_session_value_if_empty()
         self._build_required_directories()
 
-        self.films = None
+        self.works = None
         self.tropes = None
         self.urls = None
-        self.tropes_by_film = OrderedDict()
+        self.frontier = CrawlFrontier()
+        self.journals = {namespace: self._open_journal(namespace) for namespace in self.namespaces}
+        self.page_cache = self._open_page_cache(self.session)
+        self.previous_page_cache = self._open_previous_page_cache(previous_session) if previous_session else None
+        self._add_to_summary('page_cache_file_path', self.page_cache.file_path)
+        self.fetcher = PageFetcher(requests_per_second=requests_per_second, concurrent_requests=concurrent_requests)
 
     def _set_default_session_value_if_empty(self):
         if not self.session:
@@ -56,111 +86,270 @@ class TVTropesScraper(BaseScript):
             self._step(f'Building directory: {whole_path}')
             os.makedirs(whole_path)
 
+    def _get_result_name(self, namespace):
+        return self.RESULT_NAME_BY_NAMESPACE.get(namespace, namespace.lower())
+
+    def _open_journal(self, namespace):
+        file_name = self.JOURNAL_FILE_TEMPLATE.format(self._get_result_name(namespace), self.session)
+        journal = ScrapingJournal(os.path.join(self.directory_name, self.session, file_name))
+        if len(journal) > 0:
+            self._step(f'Resuming session {self.session}: {len(journal)} {namespace} works already scraped in '
+                       f'{journal.file_path}')
+        self._add_to_namespace_summary(namespace, 'journal_file_path', journal.file_path)
+        return journal
+
+    def _add_to_namespace_summary(self, namespace, key, value):
+        self.summary_dictionary.setdefault(key, {})[namespace] = value
+
+    def _open_page_cache(self, session):
+        directory = os.path.join(self.directory_name, session)
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f'Session directory not found: {directory}')
+
+        page_cache = PageCache(os.path.join(directory, self.PAGE_CACHE_FILE_NAME))
+        if len(page_cache) == 0:
+            self._import_legacy_cache_files(page_cache, directory)
+        return page_cache
+
+    def _open_previous_page_cache(self, previous_session):
+        """
+        Opens the page cache of a previous session read-only, without importing its legacy files
+        """
+        directory = os.path.join(self.directory_name, previous_session)
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f'Session directory not found: {directory}')
+
+        return PageCache(os.path.join(directory, self.PAGE_CACHE_FILE_NAME), read_only=True)
+
+    def _import_legacy_cache_files(self, page_cache, directory):
+        """
+        Packs the pages cached by previous versions of the scraper, one base64(url).html.bz2 file per page, so
+        existing sessions are not downloaded again. The old files are left untouched.
+        """
+        legacy_extension = f'{self.EXTENSION}{self.COMPRESSED_EXTENSION}'
+        file_names = [file_name for file_name in os.listdir(directory) if file_name.endswith(legacy_extension)]
+        if not file_names:
+            return
+
+        self._step(f'Importing {len(file_names)} cached pages into {page_cache.file_path}')
+        pages = []
+        for file_name in file_names:
+            encoded_url = file_name[:-len(legacy_extension)].replace('_', '/')
+            url = base64.b64decode(encoded_url).decode(self.DEFAULT_ENCODING)
+            file_path = os.path.join(directory, file_name)
+            with open(file_path, 'rb') as file:
+                content = bz2.decompress(file.read())
+            fetched_at = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
+            pages.append((url, content, fetched_at))
+            if len(pages) == self.LEGACY_IMPORT_BATCH_SIZE:
+                page_cache.put_many(pages)
+                pages = []
+        page_cache.put_many(pages)
+        self._add_to_summary('n_imported_cached_urls',
+                             self.summary_dictionary.get('n_imported_cached_urls', 0) + len(file_names))
+
     def run(self):
-        self._extract_film_ids()
+        self._extract_works()
         self._extract_tropes()
-        self._write_result()
+        for namespace in self.namespaces:
+            self._write_result(namespace)
+        self.fetcher.close()
+        for journal in self.journals.values():
+            journal.close()
+        self.page_cache.close()
+        if self.previous_page_cache is not None:
+            self.previous_page_cache.close()
         self._finish_and_summary()
 
-    def _extract_film_ids(self):
-        self.films = set()
+    def _extract_works(self):
+        self.works = {namespace: set() for namespace in self.namespaces}
         self.urls = set()
-        main_url = self.MAIN_SEARCH
-        category_ids = self._get_links_from_url(main_url, self.MAIN_RESOURCE)
+        for namespace in self.namespaces:
+            self.frontier.add(self.INDEX_PAGE, self.BASE_MAIN_URL + namespace)
+
+        index_urls = list(self.frontier.pop(self.INDEX_PAGE))
+        for url, links in self._get_links_from_urls(index_urls, [self.MAIN_RESOURCE]):
+            for category_id in links[self.MAIN_RESOURCE]:
+                self.frontier.add(self.CATEGORY_PAGE, self.BASE_MAIN_URL + category_id)
 
-        for category_id in category_ids:
-            url = self.BASE_MAIN_URL + category_id
-            film_ids = self._get_links_from_url(url, self.FILM_RESOURCE)
-            self.films.update(film_ids)
+        category_urls = list(self.frontier.pop(self.CATEGORY_PAGE))
+        resources = [f'/{namespace}/' for namespace in self.namespaces]
+        self._step(f'Found {len(category_urls)} categories')
+        for url, links in self._get_links_from_urls(category_urls, resources):
+            for namespace, resource in zip(self.namespaces, resources):
+                self.works[namespace].update(links[resource])
 
-        self._add_to_summary('n_films', len(self.films))
+        for namespace in self.namespaces:
+            self._add_to_namespace_summary(namespace, 'n_works', len(self.works[namespace]))
 
     def _extract_tropes(self):
         self.tropes = set()
-        self.tropes_by_film = OrderedDict()
-        sorted_films = sorted(list(self.films))
-
-        self._step(f'Found {len(sorted_films)} films')
-
-        for counter, film in enumerate(sorted_films):
-            self._info(f'Status: {counter}/{len(sorted_films)} films')
-            self._get_tropes_by_film(film)
+        for namespace in self.namespaces:
+            journal = self.journals[namespace]
+            for work in sorted(self.works[namespace]):
+                url = self._get_work_url(namespace, work)
+                if work in journal:
+                    self.urls.add(url)
+                    self.tropes.update(journal.get(work))
+                else:
+                    self.frontier.add(self.WORK_PAGE, url, (namespace, work))
+
+        works_to_scrape = self.frontier.pop(self.WORK_PAGE)
+        self._step(f'Found {sum(len(works) for works in self.works.values())} works, {len(works_to_scrape)} of them '
+                   f'not scraped yet')
+        links_by_work = self._get_links_from_urls(list(works_to_scrape), [self.MAIN_RESOURCE], only_article=True)
+
+        for counter, (url, links) in enumerate(links_by_work):
+            self._info(f'Status: {counter}/{len(works_to_scrape)} works')
+            self._add_tropes_by_work(*works_to_scrape[url], links[self.MAIN_RESOURCE])
 
         self._add_to_summary('n_tropes', len(self.tropes))
         self._add_to_summary('n_cached_urls', len(self.urls))
 
-    def _get_tropes_by_film(self, film):
-        url = self.BASE_FILM_URL + film
-        trope_ids = self._get_links_from_url(url, self.MAIN_RESOURCE, only_article=True)
+    def _get_work_url(self, namespace, work):
+        return f'{self.BASE_URL}{namespace}/{work}'
 
-        self._info(f'Film {film} ({len(trope_ids)} tropes): {trope_ids}')
+    def _add_tropes_by_work(self, namespace, work, trope_ids):
+        self._info(f'{namespace} {work} ({len(trope_ids)} tropes): {trope_ids}')
 
         self.tropes.update(trope_ids)
-        self.tropes_by_film[film] = sorted(trope_ids)
-
-    def _get_links_from_url(self, url, link_type, only_article=False):
-        page = self._get_content_from_url(url)
-        tree = html.fromstring(page)
+        self.journals[namespace].append(work, sorted(trope_ids))
+
+    def _get_links_from_urls(self, urls, link_types, only_article=False):
+        """
+        Yields (url, {link_type: links}) in the order of `urls`. Links are extracted by a pool of processes while the
+        next pages are still being downloaded, with at most PAGES_WAITING_PER_WORKER pages per worker waiting to be
+        parsed. Links already extracted from a cached page are not extracted again.
+        """
         selector = self.LINK_SELECTOR_INSIDE_ARTICLE if only_article else self.LINK_SELECTOR
-        links = [element.get(self.LINK_ADDRESS_SELECTOR) for element in tree.cssselect(selector)
-                 if element.get(self.LINK_ADDRESS_SELECTOR)]
-        return [link.split('/')[-1] for link in links if link_type in link and 'action' not in link]
+        extraction = ' '.join([selector] + list(link_types))
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 and len(urls) > 1 else None
+        pending_links = deque()
+        try:
+            for url, links, page in self._get_pages(urls, extraction):
+                if links is None and executor is not None:
+                    links = executor.submit(extract_links, page, selector, link_types)
+                elif links is None:
+                    links = extract_links(page, selector, link_types)
+                    self.page_cache.put_links(url, extraction, links)
+                pending_links.append((url, links))
+
+                while len(pending_links) > self.PAGES_WAITING_PER_WORKER * self.workers:
+                    yield self._get_extracted_links(*pending_links.popleft(), extraction)
+            while pending_links:
+                yield self._get_extracted_links(*pending_links.popleft(), extraction)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _get_extracted_links(self, url, links, extraction):
+        if isinstance(links, dict):
+            return url, links
+
+        links = links.result()
+        self.page_cache.put_links(url, extraction, links)
+        return url, links
+
+    def _get_pages(self, urls, extraction):
+        """
+        Yields (url, links, page) in the order of `urls`, with the links already extracted from the cached page or,
+        otherwise, its content. Pages not in the cache are downloaded a few pages ahead of the one being yielded.
+        """
+        urls_to_download = list(OrderedDict.fromkeys(url for url in urls if url not in self.page_cache))
+        validators = self._get_previous_validators(urls_to_download)
+        self._info(f'Retrieving {len(urls_to_download)} URLs from TVTropes and storing them in cache '
+                   f'({len(validators)} of them conditionally)')
+
+        downloads = self.fetcher.fetch_all(urls_to_download, validators)
+        pending_downloads = set(urls_to_download)
+        for url in urls:
+            self.urls.add(url)
+            if url in pending_downloads:
+                pending_downloads.remove(url)
+                self._download_page(*next(downloads))
+                self._info(f'Status: {len(urls_to_download) - len(pending_downloads)}/{len(urls_to_download)} '
+                           f'URLs retrieved')
+
+            links = self.page_cache.get_links(url, extraction)
+            yield url, links, self._get_content_from_url(url) if links is None else None
+
+    def _download_page(self, url, page):
+        if isinstance(page, Exception):
+            self._track_error(f'Exception retrieving URL {url}. {page}')
+            return
+        self._store_page(url, page)
+
+    def _get_previous_validators(self, urls):
+        validators = {}
+        if self.previous_page_cache is None:
+            return validators
+
+        for url in urls:
+            previous_validators = self.previous_page_cache.get_validators(url)
+            if previous_validators is not None and (previous_validators[0] or previous_validators[1]):
+                validators[url] = previous_validators[:2]
+        return validators
 
     def _get_content_from_url(self, url):
-        self.urls.add(url)
-        encoded_url = self._build_encoded_url(url)
-        file_path = os.path.join(self.directory_name, self.session, encoded_url)
+        content = self.page_cache.get(url)
 
-        if self._file_exists(file_path):
+        if content is not None:
             self._info(f'Retrieving URL from cache: {url}')
-            content = self._read_file(file_path)
             return self._read_content_safely(content)
 
         self._info(f'Retrieving URL from TVTropes and storing in cache: {url}')
-        self._wait_between_calls_to_avoid_attacking()
-        page = requests.get(url)
-        content = page.content
-        self._write_file(content, file_path)
-        return self._read_content_safely(content)
-
-    @classmethod
-    def _file_exists(cls, file_path):
-        compressed_path = f'{file_path}{cls.COMPRESSED_EXTENSION}'
-        return os.path.isfile(compressed_path)
-
-    @classmethod
-    def _read_file(cls, file_path):
-        compressed_path = f'{file_path}{cls.COMPRESSED_EXTENSION}'
-        with open(compressed_path, 'rb') as file:
-            content = file.read()
-        return bz2.decompress(content)
-
-    def _write_file(self, content, file_path):
-        compressed_path = f'{file_path}{self.COMPRESSED_EXTENSION}'
-        self.compressed_content = bz2.compress(content)
-        with open(compressed_path, 'wb') as file:
-            file.write(self.compressed_content)
-
-        self._add_to_summary('compressed_generated_file_path', compressed_path)
-        self._add_to_summary('compressed_generated_file_size_bytes', len(self.compressed_content))
+        self._store_page(url, self.fetcher.fetch(url))
+        return self._read_content_safely(self.page_cache.get(url))
+
+    def _store_page(self, url, page):
+        """
+        Stores a fetched page in the cache of the session. Pages that did not change since the previous session are
+        copied from its cache with the links already extracted from them, so they are not parsed again.
+        """
+        previous_validators = None
+        if self.previous_page_cache is not None:
+            previous_validators = self.previous_page_cache.get_validators(url)
+
+        if previous_validators is None:
+            self.page_cache.put(url, page.content, etag=page.etag, last_modified=page.last_modified)
+            change = 'new'
+        elif not page.modified or PageCache.get_content_hash(page.content) == previous_validators[2]:
+            self.page_cache.copy_page(self.previous_page_cache, url, page.etag, page.last_modified)
+            change = 'unchanged'
+        else:
+            self.page_cache.put(url, page.content, etag=page.etag, last_modified=page.last_modified)
+            change = 'changed'
+
+        downloaded_bytes = len(page.content) if page.modified else 0
+        self._add_to_summary(f'n_{change}_pages', self.summary_dictionary.get(f'n_{change}_pages', 0) + 1)
+        self._add_to_summary('downloaded_bytes', self.summary_dictionary.get('downloaded_bytes', 0) + downloaded_bytes)
 
     def _read_content_safely(self, content):
         return content.decode(self.DEFAULT_ENCODING, errors='ignore')
 
-    def _build_encoded_url(self, url):
-        encoded_url = base64.b64encode(url.encode(self.DEFAULT_ENCODING)).decode(self.DEFAULT_ENCODING) + self.EXTENSION
-        return encoded_url.replace('/', '_')
-
-    def _wait_between_calls_to_avoid_attacking(self):
-        sleep(self.WAIT_TIME_BETWEEN_CALLS_IN_SECONDS)
-
-    def _write_result(self):
-        target_file_name = self.TARGET_RESULT_FILE_TEMPLATE.format(self.session)
+    def _write_result(self, namespace):
+        target_file_name = self.TARGET_RESULT_FILE_TEMPLATE.format(self._get_result_name(namespace), self.session)
         file_path = os.path.join(self.directory_name, self.session, target_file_name)
-        self._step(f'Saving tropes by film into {file_path}')
-        content = json.dumps(self.tropes_by_film, indent=2, sort_keys=True)
-        self.byte_content = content.encode(self.DEFAULT_ENCODING)
-        self._write_file(self.byte_content, file_path)
-
-        self._add_to_summary('uncompressed_generated_file_path', file_path)
-        self._add_to_summary('uncompressed_generated_file_size_bytes', len(self.byte_content))
+        compressed_path = f'{file_path}{self.COMPRESSED_EXTENSION}'
+        self._step(f'Saving tropes by {namespace} work into {compressed_path}')
+        with open_bz2_writer(compressed_path, encoding=self.DEFAULT_ENCODING) as file:
+            self._write_tropes_by_work(file, namespace)
+
+        self._add_to_namespace_summary(namespace, 'compressed_generated_file_path', compressed_path)
+        self._add_to_namespace_summary(namespace, 'compressed_generated_file_size_bytes', file.buffer.compressed_size)
+        self._add_to_namespace_summary(namespace, 'uncompressed_generated_file_path', file_path)
+        self._add_to_namespace_summary(namespace, 'uncompressed_generated_file_size_bytes',
+                                       file.buffer.uncompressed_size)
+
+    def _write_tropes_by_work(self, file, namespace):
+        """
+        Writes the tropes of the works of a namespace in its journal one by one, with the same format as
+        json.dump(tropes_by_work, indent=2, sort_keys=True)
+        """
+        journal = self.journals[namespace]
+        works = sorted(work for work in self.works[namespace] if work in journal)
+        file.write('{')
+        for counter, work in enumerate(works):
+            tropes = json.dumps(journal.get(work), indent=2).replace('\n', '\n  ')
+            file.write(f'{"," if counter else ""}\n  {json.dumps(work)}: {tropes}')
+        file.write('\n}' if works else '}')